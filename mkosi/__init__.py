@@ -5,6 +5,7 @@ from __future__ import annotations
 import argparse
 import ast
 import collections
+import concurrent.futures
 import configparser
 import contextlib
 import crypt
@@ -25,7 +26,6 @@ import math
 import os
 import platform
 import re
-import shlex
 import shutil
 import stat
 import string
@@ -79,8 +79,10 @@ from .backend import (
     patch_file,
     path_relative_to_cwd,
     run,
+    run_concurrently,
     run_with_backoff,
     run_workspace_command,
+    shell_join,
     should_compress_fs,
     should_compress_output,
     spawn,
@@ -127,15 +129,30 @@ DRACUT_SYSTEMD_EXTRAS = [
 ]
 
 
+@functools.lru_cache(maxsize=None)
+def read_resource(resource: str, key: str) -> bytes:
+    return importlib.resources.read_binary(resource, key)
+
+
+@functools.lru_cache(maxsize=None)
+def which(command: str) -> Optional[str]:
+    # Every lookup stats the command in each $PATH entry, and we look up the same few commands over and over
+    return shutil.which(command)
+
+
 def write_resource(
         where: Path, resource: str, key: str, *, executable: bool = False, mode: Optional[int] = None
 ) -> None:
-    text = importlib.resources.read_text(resource, key)
-    where.write_text(text)
-    if mode is not None:
-        where.chmod(mode)
-    elif executable:
-        make_executable(where)
+    if mode is None and executable:
+        mode = 0o755
+
+    # Create the file with its final mode right away, rather than stat()ing and fixing it up afterwards
+    with open_close(where, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644 if mode is None else mode) as fd:
+        if mode is not None:
+            # The file might have existed already, in which case O_CREAT didn't apply the mode
+            os.fchmod(fd, mode)
+        with open(fd, "wb", closefd=False) as f:
+            f.write(read_resource(resource, key))
 
 
 T = TypeVar("T")
@@ -156,6 +173,9 @@ def dictify(f: Callable[..., Generator[Tuple[T, V], None, None]]) -> Callable[..
     return functools.update_wrapper(wrapper, f)
 
 
+OS_RELEASE_NAME_RE = re.compile(r"[A-Z][A-Z_0-9]+")
+
+
 @dictify
 def read_os_release() -> Generator[Tuple[str, str], None, None]:
     try:
@@ -169,19 +189,22 @@ def read_os_release() -> Generator[Tuple[str, str], None, None]:
         line = line.rstrip()
         if not line or line.startswith("#"):
             continue
-        m = re.match(r"([A-Z][A-Z_0-9]+)=(.*)", line)
-        if m:
-            name, val = m.groups()
+        name, eq, val = line.partition("=")
+        if eq and OS_RELEASE_NAME_RE.fullmatch(name):
             if val and val[0] in "\"'":
-                val = ast.literal_eval(val)
+                # Only bother with a full parse if there's more than a plain quoted string
+                if len(val) > 1 and val[-1] == val[0] and val[0] not in val[1:-1] and "\\" not in val:
+                    val = val[1:-1]
+                else:
+                    val = ast.literal_eval(val)
             yield name, val
         else:
             print(f"{filename}:{line_number}: bad line {line!r}", file=sys.stderr)
 
 
-def print_running_cmd(cmdline: Iterable[str]) -> None:
+def print_running_cmd(cmdline: Sequence[PathString]) -> None:
     MkosiPrinter.print_step("Running command:")
-    MkosiPrinter.print_step(" ".join(shlex.quote(x) for x in cmdline) + "\n")
+    MkosiPrinter.print_step(shell_join(cmdline) + "\n")
 
 
 GPT_ROOT_X86           = uuid.UUID("44479540f29741b29af7d131d5f0458a")  # NOQA: E221
@@ -221,6 +244,8 @@ BIOS_PARTITION_SIZE = 1024 * 1024
 
 CLONE_NEWNS = 0x00020000
 
+MS_BIND = 4096
+
 FEDORA_KEYS_MAP = {
     "7":  "CAB44B996F27744E86127CDFB44269D04F2A6FD2",
     "8":  "4FFF1F04010DEDCAE203591D62AEC3DC6DF2196F",
@@ -270,6 +295,26 @@ class GPTRootTypePair(NamedTuple):
     verity: uuid.UUID
 
 
+X86_ARCHITECTURES = ("i386", "i486", "i586", "i686")
+
+GPT_ROOT_TYPES = {
+    **{arch: GPTRootTypePair(GPT_ROOT_X86, GPT_ROOT_X86_VERITY) for arch in X86_ARCHITECTURES},
+    "x86_64": GPTRootTypePair(GPT_ROOT_X86_64, GPT_ROOT_X86_64_VERITY),
+    "aarch64": GPTRootTypePair(GPT_ROOT_ARM_64, GPT_ROOT_ARM_64_VERITY),
+    "armv7l": GPTRootTypePair(GPT_ROOT_ARM, GPT_ROOT_ARM_VERITY),
+}
+
+GPT_USR_TYPES = {
+    **{arch: GPTRootTypePair(GPT_USR_X86, GPT_USR_X86_VERITY) for arch in X86_ARCHITECTURES},
+    "x86_64": GPTRootTypePair(GPT_USR_X86_64, GPT_USR_X86_64_VERITY),
+    "aarch64": GPTRootTypePair(GPT_USR_ARM_64, GPT_USR_ARM_64_VERITY),
+    "armv7l": GPTRootTypePair(GPT_USR_ARM, GPT_USR_ARM_VERITY),
+}
+
+# The architecture of the host doesn't change while we run
+HOST_ARCHITECTURE = platform.machine()
+
+
 def gpt_root_native(arch: Optional[str], usr_only: bool = False) -> GPTRootTypePair:
     """The tag for the native GPT root partition for the given architecture
 
@@ -277,30 +322,13 @@ def gpt_root_native(arch: Optional[str], usr_only: bool = False) -> GPTRootTypeP
     matching verity partition.
     """
     if arch is None:
-        arch = platform.machine()
+        arch = HOST_ARCHITECTURE
 
-    if usr_only:
-        if arch in ("i386", "i486", "i586", "i686"):
-            return GPTRootTypePair(GPT_USR_X86, GPT_USR_X86_VERITY)
-        elif arch == "x86_64":
-            return GPTRootTypePair(GPT_USR_X86_64, GPT_USR_X86_64_VERITY)
-        elif arch == "aarch64":
-            return GPTRootTypePair(GPT_USR_ARM_64, GPT_USR_ARM_64_VERITY)
-        elif arch == "armv7l":
-            return GPTRootTypePair(GPT_USR_ARM, GPT_USR_ARM_VERITY)
-        else:
-            die(f"Unknown architecture {arch}.")
-    else:
-        if arch in ("i386", "i486", "i586", "i686"):
-            return GPTRootTypePair(GPT_ROOT_X86, GPT_ROOT_X86_VERITY)
-        elif arch == "x86_64":
-            return GPTRootTypePair(GPT_ROOT_X86_64, GPT_ROOT_X86_64_VERITY)
-        elif arch == "aarch64":
-            return GPTRootTypePair(GPT_ROOT_ARM_64, GPT_ROOT_ARM_64_VERITY)
-        elif arch == "armv7l":
-            return GPTRootTypePair(GPT_ROOT_ARM, GPT_ROOT_ARM_VERITY)
-        else:
-            die(f"Unknown architecture {arch}.")
+    pair = (GPT_USR_TYPES if usr_only else GPT_ROOT_TYPES).get(arch)
+    if pair is None:
+        die(f"Unknown architecture {arch}.")
+
+    return pair
 
 
 def roothash_suffix(usr_only: bool = False) -> str:
@@ -310,26 +338,48 @@ def roothash_suffix(usr_only: bool = False) -> str:
     return ".roothash"
 
 
-def unshare(flags: int) -> None:
-    libc_name = ctypes.util.find_library("c")
-    if libc_name is None:
-        die("Could not find libc")
-    libc = ctypes.CDLL(libc_name, use_errno=True)
+@functools.lru_cache(maxsize=None)
+def libc() -> ctypes.CDLL:
+    # find_library() may spawn ldconfig or a compiler to locate the library, so only do it once. If it can't
+    # find it, passing None gets us the symbols already loaded into our own process, which includes libc.
+    lib = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+
+    lib.unshare.argtypes = [ctypes.c_int]
+    lib.unshare.restype = ctypes.c_int
+    # Only used for FICLONE, which takes the source fd as its argument
+    lib.ioctl.argtypes = [ctypes.c_int, ctypes.c_ulong, ctypes.c_int]
+    lib.ioctl.restype = ctypes.c_int
+    lib.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+    lib.mount.restype = ctypes.c_int
+    lib.umount2.argtypes = [ctypes.c_char_p, ctypes.c_int]
+    lib.umount2.restype = ctypes.c_int
 
-    if libc.unshare(ctypes.c_int(flags)) != 0:
+    return lib
+
+
+def unshare(flags: int) -> None:
+    if libc().unshare(flags) != 0:
         e = ctypes.get_errno()
         raise OSError(e, os.strerror(e))
 
 
+def mount_syscall(what: PathString, where: PathString, fstype: Optional[str] = None, flags: int = 0) -> None:
+    "Call mount(2) directly, saving the fork and exec of mount(8) for simple mounts that need no helper"
+    if libc().mount(os.fsencode(what), os.fsencode(where), fstype.encode() if fstype else None, flags, None) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), str(where))
+
+
+BYTE_UNITS = ("K", "M", "G")
+
+
 def format_bytes(num_bytes: int) -> str:
-    if num_bytes >= 1024 * 1024 * 1024:
-        return f"{num_bytes/1024**3 :0.1f}G"
-    if num_bytes >= 1024 * 1024:
-        return f"{num_bytes/1024**2 :0.1f}M"
-    if num_bytes >= 1024:
-        return f"{num_bytes/1024 :0.1f}K"
+    # Every unit is 10 bits wide, so the bit length tells us which unit to use
+    unit = min((num_bytes.bit_length() - 1) // 10, len(BYTE_UNITS)) if num_bytes > 0 else 0
+    if unit == 0:
+        return f"{num_bytes}B"
 
-    return f"{num_bytes}B"
+    return f"{num_bytes / (1 << (10 * unit)) :0.1f}{BYTE_UNITS[unit - 1]}"
 
 
 def roundup(x: int, step: int) -> int:
@@ -362,6 +412,8 @@ def _IOW(type_drv: int, nr: int, size: str) -> int:
 
 FICLONE = _IOW(0x94, 9, "int")
 
+F_SETPIPE_SZ = 1031
+
 
 @contextlib.contextmanager
 def open_close(path: PathString, flags: int, mode: int = 0o664) -> Generator[int, None, None]:
@@ -372,8 +424,98 @@ def open_close(path: PathString, flags: int, mode: int = 0o664) -> Generator[int
         os.close(fd)
 
 
+def write_file(path: PathString, text: str, mode: Optional[int] = None) -> None:
+    "Create or truncate @path and write @text to it, without going through Python's buffered IO"
+    with open_close(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644 if mode is None else mode) as fd:
+        if mode is not None:
+            # The file might have existed already, in which case O_CREAT didn't apply the mode
+            os.fchmod(fd, mode)
+        os.write(fd, text.encode())
+
+
 def _reflink(oldfd: int, newfd: int) -> None:
-    fcntl.ioctl(newfd, FICLONE, oldfd)
+    # This is called for every file we copy, so call into libc directly rather than having fcntl.ioctl()
+    # figure out how to marshal its argument every time.
+    if libc().ioctl(newfd, FICLONE, oldfd) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+
+def _data_segments(fd: int, size: int) -> Generator[Tuple[int, int], None, None]:
+    """Yield the (offset, length) pairs of the parts of the file that aren't holes"""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                # Only a hole is left
+                return
+            if e.errno != errno.EINVAL:
+                raise
+            # The file system doesn't know about holes
+            yield offset, size - offset
+            return
+
+        end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        yield start, end - start
+        offset = end
+
+
+def _copy_range(oldfd: int, newfd: int, offset: int, length: int) -> None:
+    end = offset + length
+
+    if sys.version_info >= (3, 8):
+        try:
+            while offset < end:
+                n = os.copy_file_range(oldfd, newfd, end - offset, offset, offset)
+                if n == 0:
+                    return
+                offset += n
+            return
+        except OSError as e:
+            if e.errno not in {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}:
+                raise
+
+    try:
+        os.lseek(newfd, offset, os.SEEK_SET)
+        while offset < end:
+            n = os.sendfile(newfd, oldfd, offset, end - offset)
+            if n == 0:
+                return
+            offset += n
+        return
+    except OSError as e:
+        if e.errno not in {errno.ENOSYS, errno.EINVAL}:
+            raise
+
+    while offset < end:
+        data = os.pread(oldfd, min(end - offset, 1024 * 1024), offset)
+        if not data:
+            return
+        offset += os.pwrite(newfd, data, offset)
+
+
+def _copy_data(oldfd: int, newfd: int) -> None:
+    """Copy the contents of oldfd to newfd
+
+    Prefer copy_file_range() and sendfile(), which copy in the kernel
+    without bouncing the data through a userspace buffer, and only
+    fall back to a plain read/write loop if neither is supported.
+    Holes are skipped rather than filled with zeroes, which matters a
+    lot for mostly empty disk images.
+    """
+    size = os.fstat(oldfd).st_size
+
+    # We read the whole file front to back, so let the kernel read ahead aggressively while we write.
+    os.posix_fadvise(oldfd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+    for offset, length in _data_segments(oldfd, size):
+        _copy_range(oldfd, newfd, offset, length)
+
+    # Recreate any trailing hole and leave the offset at the end, like a sequential copy would
+    os.ftruncate(newfd, size)
+    os.lseek(newfd, size, os.SEEK_SET)
 
 
 def copy_fd(oldfd: int, newfd: int) -> None:
@@ -382,8 +524,7 @@ def copy_fd(oldfd: int, newfd: int) -> None:
     except OSError as e:
         if e.errno not in {errno.EXDEV, errno.EOPNOTSUPP}:
             raise
-        # While mypy handles this correctly, Pyright doesn't yet.
-        shutil.copyfileobj(open(oldfd, "rb", closefd=False), cast(Any, open(newfd, "wb", closefd=False)))
+        _copy_data(oldfd, newfd)
 
 
 def copy_file_object(oldobject: BinaryIO, newobject: BinaryIO) -> None:
@@ -392,63 +533,114 @@ def copy_file_object(oldobject: BinaryIO, newobject: BinaryIO) -> None:
     except OSError as e:
         if e.errno not in {errno.EXDEV, errno.EOPNOTSUPP}:
             raise
-        shutil.copyfileobj(oldobject, newobject)
+        # We copy on the underlying fds directly, so flush any buffered data first and resync afterwards
+        newobject.flush()
+        _copy_data(oldobject.fileno(), newobject.fileno())
+        newobject.seek(0, os.SEEK_END)
 
 
-def copy_file(oldpath: PathString, newpath: PathString) -> None:
-    oldpath = Path(oldpath)
-    newpath = Path(newpath)
+def copy_file(oldpath: PathString, newpath: PathString, st: Optional[os.stat_result] = None) -> None:
+    """Copy a file, or recreate a symlink
 
-    if oldpath.is_symlink():
-        src = os.readlink(oldpath)  # TODO: use oldpath.readlink() with python3.9+
-        newpath.symlink_to(src)
+    If the caller already knows oldpath is a regular file, it can pass
+    in its stat result to save us from looking it up again.
+    """
+    # This is called for every file in copy_path(), so stick to plain os functions rather than creating Path
+    # objects.
+    if st is None and os.path.islink(oldpath):
+        src = os.readlink(oldpath)
+        os.symlink(src, newpath)
         return
 
     with open_close(oldpath, os.O_RDONLY) as oldfd:
-        st = os.stat(oldfd)
+        if st is None:
+            st = os.stat(oldfd)
 
         try:
             with open_close(newpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, st.st_mode) as newfd:
                 copy_fd(oldfd, newfd)
         except FileExistsError:
-            newpath.unlink()
+            os.unlink(newpath)
             with open_close(newpath, os.O_WRONLY | os.O_CREAT, st.st_mode) as newfd:
                 copy_fd(oldfd, newfd)
     shutil.copystat(oldpath, newpath, follow_symlinks=False)
 
 
-def symlink_f(target: str, path: Path) -> None:
+def symlink_f(target: str, path: PathString, dir_fd: Optional[int] = None) -> None:
     try:
-        path.symlink_to(target)
+        os.symlink(target, path, dir_fd=dir_fd)
     except FileExistsError:
-        os.unlink(path)
-        path.symlink_to(target)
+        os.unlink(path, dir_fd=dir_fd)
+        os.symlink(target, path, dir_fd=dir_fd)
 
 
-def copy_path(oldpath: PathString, newpath: Path) -> None:
+@functools.lru_cache(maxsize=None)
+def io_executor() -> concurrent.futures.ThreadPoolExecutor:
+    # Copying or removing a tree is dominated by syscall latency rather than CPU, and the GIL is released while
+    # we wait for the kernel, so handle the individual files from a shared pool of threads.
+    return concurrent.futures.ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+
+
+def mkdir_f(path: PathString, dir_fd: Optional[int] = None) -> None:
     try:
-        newpath.mkdir(exist_ok=True)
+        os.mkdir(path, dir_fd=dir_fd)
     except FileExistsError:
+        if stat.S_ISDIR(os.stat(path, dir_fd=dir_fd).st_mode):
+            return
         # something that is not a directory already exists
-        newpath.unlink()
-        newpath.mkdir()
-
-    for entry in os.scandir(oldpath):
-        newentry = newpath / entry.name
-        if entry.is_dir(follow_symlinks=False):
-            copy_path(entry.path, newentry)
-        elif entry.is_symlink():
-            target = os.readlink(entry.path)
-            symlink_f(target, newentry)
-            shutil.copystat(entry.path, newentry, follow_symlinks=False)
-        else:
-            st = entry.stat(follow_symlinks=False)
-            if stat.S_ISREG(st.st_mode):
-                copy_file(entry.path, newentry)
-            else:
-                print("Ignoring", entry.path)
-                continue
-    shutil.copystat(oldpath, newpath, follow_symlinks=True)
+        os.unlink(path, dir_fd=dir_fd)
+        os.mkdir(path, dir_fd=dir_fd)
+
+
+def _raise(e: OSError) -> NoReturn:
+    raise e
+
+
+def copy_path(oldpath: PathString, newpath: Path) -> None:
+    futures: List[concurrent.futures.Future[None]] = []
+    newdirs = {os.fspath(oldpath): os.fspath(newpath)}
+    dirs: List[Tuple[str, str]] = []
+
+    mkdir_f(newpath)
+
+    try:
+        # Walk the tree iteratively and work relative to the fds of the source and target directories, so
+        # that we neither recurse in Python nor make the kernel resolve the full path of every entry again.
+        # fwalk() silently skips directories it can't open, which would leave them empty in the copy, so make
+        # it fail instead.
+        for dirpath, dirnames, filenames, dirfd in os.fwalk(oldpath, follow_symlinks=False, onerror=_raise):
+            newdir = newdirs.pop(dirpath)
+            dirs.append((dirpath, newdir))
+
+            with open_close(newdir, os.O_RDONLY | os.O_DIRECTORY) as newdirfd:
+                for name in dirnames + filenames:
+                    oldentry = os.path.join(dirpath, name)
+                    newentry = os.path.join(newdir, name)
+                    st = os.stat(name, dir_fd=dirfd, follow_symlinks=False)
+
+                    if stat.S_ISDIR(st.st_mode):
+                        mkdir_f(name, dir_fd=newdirfd)
+                        newdirs[oldentry] = newentry
+                    elif stat.S_ISLNK(st.st_mode):
+                        target = os.readlink(name, dir_fd=dirfd)
+                        symlink_f(target, name, dir_fd=newdirfd)
+                        shutil.copystat(oldentry, newentry, follow_symlinks=False)
+                    elif stat.S_ISREG(st.st_mode):
+                        # The files are copied asynchronously, after the fds of this iteration are gone already,
+                        # so these get full paths.
+                        futures.append(io_executor().submit(copy_file, oldentry, newentry, st))
+                    else:
+                        print("Ignoring", oldentry)
+    finally:
+        concurrent.futures.wait(futures)
+
+    for future in futures:
+        future.result()
+
+    # Creating files updates the directory timestamps, so we can only copy those over once all files are in
+    # place. Parents are listed before their children, hence go backwards to handle the deepest ones first.
+    for olddir, newdir in reversed(dirs):
+        shutil.copystat(olddir, newdir, follow_symlinks=True)
 
 
 @complete_step("Detaching namespace")
@@ -480,18 +672,27 @@ def btrfs_subvol_delete(path: Path) -> None:
     # Extract the path of the subvolume relative to the filesystem
     c = run(["btrfs", "subvol", "show", path], stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
     subvol_path = c.stdout.splitlines()[0]
-    # Make the subvolume RW again if it was set RO by btrfs_subvol_delete
-    run(["btrfs", "property", "set", path, "ro", "false"])
-    # Recursively delete the direct children of the subvolume
-    c = run(["btrfs", "subvol", "list", "-o", path], stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
-    for line in c.stdout.splitlines():
-        if not line:
-            continue
-        child_subvol_path = line.split(" ", 8)[-1]
-        child_path = path / cast(str, os.path.relpath(child_subvol_path, subvol_path))
-        btrfs_subvol_delete(child_path)
-    # Delete the subvolume now that all its descendants have been deleted
-    run(["btrfs", "subvol", "delete", path], stdout=DEVNULL, stderr=DEVNULL)
+
+    # Walk the tree of subvolumes iteratively, listing only the direct children (-o) of each one rather than
+    # every subvolume on the file system, and collect them so they can all be deleted in one go.
+    subvols: List[Path] = []
+    todo = [path]
+    while todo:
+        p = todo.pop()
+        # Make the subvolume RW again if it was set RO by btrfs_subvol_make_ro(), since we can't remove
+        # subvolumes nested in a read-only one.
+        run(["btrfs", "property", "set", p, "ro", "false"])
+        subvols.append(p)
+
+        c = run(["btrfs", "subvol", "list", "-o", p], stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
+        for line in c.stdout.splitlines():
+            if not line:
+                continue
+            child_subvol_path = line.split(" ", 8)[-1]
+            todo.append(path / os.path.relpath(child_subvol_path, subvol_path))
+
+    # Every subvolume is listed after its parent, so going backwards deletes each one once it is empty
+    run(["btrfs", "subvol", "delete", *reversed(subvols)], stdout=DEVNULL, stderr=DEVNULL)
 
 
 def btrfs_subvol_make_ro(path: Path, b: bool = True) -> None:
@@ -507,7 +708,7 @@ def btrfs_forget_stale_devices(args: CommandLineArguments) -> Generator[None, No
     try:
         yield
     finally:
-        if args.output_format.is_btrfs() and shutil.which("btrfs"):
+        if args.output_format.is_btrfs() and which("btrfs"):
             run(["btrfs", "device", "scan", "-u"])
 
 
@@ -522,28 +723,27 @@ def image_size(args: CommandLineArguments) -> int:
     gpt = PartitionTable.empty(args.gpt_first_lba)
     size = gpt.first_usable_offset() + gpt.footer_size()
 
-    if args.root_size is not None:
-        size += args.root_size
-    if args.home_size is not None:
-        size += args.home_size
-    if args.srv_size is not None:
-        size += args.srv_size
-    if args.var_size is not None:
-        size += args.var_size
-    if args.tmp_size is not None:
-        size += args.tmp_size
+    size += sum(
+        s
+        for s in (
+            args.root_size,
+            args.home_size,
+            args.srv_size,
+            args.var_size,
+            args.tmp_size,
+            args.xbootldr_size,
+            args.swap_size,
+            args.verity_size,
+        )
+        if s is not None
+    )
+
     if args.bootable:
         if "uefi" in args.boot_protocols:
             assert args.esp_size
             size += args.esp_size
         if "bios" in args.boot_protocols:
             size += BIOS_PARTITION_SIZE
-    if args.xbootldr_size is not None:
-        size += args.xbootldr_size
-    if args.swap_size is not None:
-        size += args.swap_size
-    if args.verity_size is not None:
-        size += args.verity_size
 
     return size
 
@@ -595,92 +795,184 @@ def root_partition_name(
     return prefix + " Partition"
 
 
-def determine_partition_table(args: CommandLineArguments) -> Tuple[str, bool]:
+# The sfdisk lines for the partitions with a fixed type and name. Only the size needs to be filled in.
+SFDISK_ESP_LINE      = f'size={{}}, type={GPT_ESP}, name="ESP System Partition"'  # NOQA: E221
+SFDISK_BIOS_LINE     = f'size={BIOS_PARTITION_SIZE // 512}, type={GPT_BIOS}, name="BIOS Boot Partition"'  # NOQA: E221
+SFDISK_XBOOTLDR_LINE = f'size={{}}, type={GPT_XBOOTLDR}, name="Boot Loader Partition"'  # NOQA: E221
+SFDISK_SWAP_LINE     = f'size={{}}, type={GPT_SWAP}, name="Swap Partition"'  # NOQA: E221
+SFDISK_HOME_LINE     = f'size={{}}, type={GPT_HOME}, name="Home Partition"'  # NOQA: E221
+SFDISK_SRV_LINE      = f'size={{}}, type={GPT_SRV}, name="Server Data Partition"'  # NOQA: E221
+SFDISK_VAR_LINE      = f'size={{}}, type={GPT_VAR}, name="Variable Data Partition"'  # NOQA: E221
+SFDISK_TMP_LINE      = f'size={{}}, type={GPT_TMP}, name="Temporary Data Partition"'  # NOQA: E221
+
+
+class PartitionTableConfig(NamedTuple):
+    """The subset of the configuration that determines the partition table"""
+
+    gpt_first_lba: Optional[int]
+    bootable: bool
+    boot_protocols: Tuple[str, ...]
+    esp_size: Optional[int]
+    xbootldr_size: Optional[int]
+    swap_size: Optional[int]
+    home_size: Optional[int]
+    srv_size: Optional[int]
+    var_size: Optional[int]
+    tmp_size: Optional[int]
+    output_format: OutputFormat
+    generated_root: bool
+    architecture: Optional[str]
+    usr_only: bool
+    read_only: bool
+    root_partition_name: str
+    verity: bool
+
+    @classmethod
+    def from_args(cls, args: CommandLineArguments) -> PartitionTableConfig:
+        return cls(
+            args.gpt_first_lba,
+            args.bootable,
+            tuple(args.boot_protocols),
+            args.esp_size,
+            args.xbootldr_size,
+            args.swap_size,
+            args.home_size,
+            args.srv_size,
+            args.var_size,
+            args.tmp_size,
+            args.output_format,
+            args.generated_root,
+            args.architecture,
+            args.usr_only,
+            args.read_only,
+            root_partition_name(args),
+            args.verity,
+        )
+
+
+class PartitionTableLayout(NamedTuple):
+    table: bytes
+    run_sfdisk: bool
+    esp_partno: Optional[int]
+    bios_partno: Optional[int]
+    xbootldr_partno: Optional[int]
+    swap_partno: Optional[int]
+    home_partno: Optional[int]
+    srv_partno: Optional[int]
+    var_partno: Optional[int]
+    tmp_partno: Optional[int]
+    root_partno: int
+    verity_partno: Optional[int]
+
+
+@functools.lru_cache(maxsize=None)
+def partition_table_layout(config: PartitionTableConfig) -> PartitionTableLayout:
     pn = 1
-    table = "label: gpt\n"
-    if args.gpt_first_lba is not None:
-        table += f"first-lba: {args.gpt_first_lba:d}\n"
+    lines = ["label: gpt"]
+    if config.gpt_first_lba is not None:
+        lines.append(f"first-lba: {config.gpt_first_lba:d}")
     run_sfdisk = False
-    args.esp_partno = None
-    args.bios_partno = None
-
-    if args.bootable:
-        if "uefi" in args.boot_protocols:
-            assert args.esp_size is not None
-            table += f'size={args.esp_size // 512}, type={GPT_ESP}, name="ESP System Partition"\n'
-            args.esp_partno = pn
+    esp_partno = bios_partno = xbootldr_partno = swap_partno = None
+    home_partno = srv_partno = var_partno = tmp_partno = verity_partno = None
+
+    if config.bootable:
+        if "uefi" in config.boot_protocols:
+            assert config.esp_size is not None
+            lines.append(SFDISK_ESP_LINE.format(config.esp_size // 512))
+            esp_partno = pn
             pn += 1
 
-        if "bios" in args.boot_protocols:
-            table += f'size={BIOS_PARTITION_SIZE // 512}, type={GPT_BIOS}, name="BIOS Boot Partition"\n'
-            args.bios_partno = pn
+        if "bios" in config.boot_protocols:
+            lines.append(SFDISK_BIOS_LINE)
+            bios_partno = pn
             pn += 1
 
         run_sfdisk = True
 
-    if args.xbootldr_size is not None:
-        table += f'size={args.xbootldr_size // 512}, type={GPT_XBOOTLDR}, name="Boot Loader Partition"\n'
-        args.xbootldr_partno = pn
+    if config.xbootldr_size is not None:
+        lines.append(SFDISK_XBOOTLDR_LINE.format(config.xbootldr_size // 512))
+        xbootldr_partno = pn
         pn += 1
-    else:
-        args.xbootldr_partno = None
 
-    if args.swap_size is not None:
-        table += f'size={args.swap_size // 512}, type={GPT_SWAP}, name="Swap Partition"\n'
-        args.swap_partno = pn
+    if config.swap_size is not None:
+        lines.append(SFDISK_SWAP_LINE.format(config.swap_size // 512))
+        swap_partno = pn
         pn += 1
         run_sfdisk = True
-    else:
-        args.swap_partno = None
-
-    args.home_partno = None
-    args.srv_partno = None
-    args.var_partno = None
-    args.tmp_partno = None
 
-    if args.output_format != OutputFormat.gpt_btrfs:
-        if args.home_size is not None:
-            table += f'size={args.home_size // 512}, type={GPT_HOME}, name="Home Partition"\n'
-            args.home_partno = pn
+    if config.output_format != OutputFormat.gpt_btrfs:
+        if config.home_size is not None:
+            lines.append(SFDISK_HOME_LINE.format(config.home_size // 512))
+            home_partno = pn
             pn += 1
             run_sfdisk = True
 
-        if args.srv_size is not None:
-            table += f'size={args.srv_size // 512}, type={GPT_SRV}, name="Server Data Partition"\n'
-            args.srv_partno = pn
+        if config.srv_size is not None:
+            lines.append(SFDISK_SRV_LINE.format(config.srv_size // 512))
+            srv_partno = pn
             pn += 1
             run_sfdisk = True
 
-        if args.var_size is not None:
-            table += f'size={args.var_size // 512}, type={GPT_VAR}, name="Variable Data Partition"\n'
-            args.var_partno = pn
+        if config.var_size is not None:
+            lines.append(SFDISK_VAR_LINE.format(config.var_size // 512))
+            var_partno = pn
             pn += 1
             run_sfdisk = True
 
-        if args.tmp_size is not None:
-            table += f'size={args.tmp_size // 512}, type={GPT_TMP}, name="Temporary Data Partition"\n'
-            args.tmp_partno = pn
+        if config.tmp_size is not None:
+            lines.append(SFDISK_TMP_LINE.format(config.tmp_size // 512))
+            tmp_partno = pn
             pn += 1
             run_sfdisk = True
 
-    if not is_generated_root(args):
-        table += 'type={}, attrs={}, name="{}"\n'.format(
-            gpt_root_native(args.architecture, args.usr_only).root,
-            "GUID:60" if args.read_only and args.output_format != OutputFormat.gpt_btrfs else "",
-            root_partition_name(args),
-        )
+    if not config.generated_root:
+        lines.append('type={}, attrs={}, name="{}"'.format(
+            gpt_root_native(config.architecture, config.usr_only).root,
+            "GUID:60" if config.read_only and config.output_format != OutputFormat.gpt_btrfs else "",
+            config.root_partition_name,
+        ))
         run_sfdisk = True
 
-    args.root_partno = pn
+    root_partno = pn
     pn += 1
 
-    if args.verity:
-        args.verity_partno = pn
+    if config.verity:
+        verity_partno = pn
         pn += 1
-    else:
-        args.verity_partno = None
 
-    return table, run_sfdisk
+    return PartitionTableLayout(
+        ("\n".join(lines) + "\n").encode("utf-8"),
+        run_sfdisk,
+        esp_partno,
+        bios_partno,
+        xbootldr_partno,
+        swap_partno,
+        home_partno,
+        srv_partno,
+        var_partno,
+        tmp_partno,
+        root_partno,
+        verity_partno,
+    )
+
+
+def determine_partition_table(args: CommandLineArguments) -> Tuple[bytes, bool]:
+    # This is called more than once per build with the same configuration, so cache the layout and only
+    # copy the partition numbers over.
+    layout = partition_table_layout(PartitionTableConfig.from_args(args))
+
+    args.esp_partno = layout.esp_partno
+    args.bios_partno = layout.bios_partno
+    args.xbootldr_partno = layout.xbootldr_partno
+    args.swap_partno = layout.swap_partno
+    args.home_partno = layout.home_partno
+    args.srv_partno = layout.srv_partno
+    args.var_partno = layout.var_partno
+    args.tmp_partno = layout.tmp_partno
+    args.root_partno = layout.root_partno
+    args.verity_partno = layout.verity_partno
+
+    return layout.table, layout.run_sfdisk
 
 
 def exec_sfdisk(args: CommandLineArguments, f: BinaryIO) -> None:
@@ -688,7 +980,7 @@ def exec_sfdisk(args: CommandLineArguments, f: BinaryIO) -> None:
     table, run_sfdisk = determine_partition_table(args)
 
     if run_sfdisk:
-        run(["sfdisk", "--color=never", f.name], input=table.encode("utf-8"))
+        run(["sfdisk", "--color=never", f.name], input=table)
         run(["sync"])
 
     args.ran_sfdisk = run_sfdisk
@@ -857,109 +1149,98 @@ def optional_partition(loopdev: Path, partno: Optional[int]) -> Optional[Path]:
     return partition(loopdev, partno)
 
 
-def prepare_swap(args: CommandLineArguments, loopdev: Optional[Path], cached: bool) -> None:
-    if loopdev is None:
-        return
-    if cached:
-        return
-    if args.swap_partno is None:
-        return
-
-    with complete_step("Formatting swap partition"):
-        run(["mkswap", "-Lswap", partition(loopdev, args.swap_partno)])
+# We only ever create file systems on freshly truncated and hence entirely sparse image files, so there's no
+# point in having mkfs discard all blocks of the device first. On a loop device that means punching holes
+# into a file that consists of nothing but holes.
+MKFS_EXT4_CMD = ("mkfs.ext4", "-I", "256", "-E", "nodiscard")
+MKFS_XFS_CMD = ("mkfs.xfs", "-n", "ftype=1", "-K")
+MKFS_BTRFS_CMD = ("mkfs.btrfs", "-d", "single", "-m", "single", "-K")
 
 
-def prepare_esp(args: CommandLineArguments, loopdev: Optional[Path], cached: bool) -> None:
-    if loopdev is None:
-        return
-    if cached:
-        return
-    if args.esp_partno is None:
-        return
+def mkfs_base_cmd(args: CommandLineArguments) -> List[PathString]:
+    "The part of the mkfs command line that is the same for all partitions of the image"
+    if args.output_format == OutputFormat.gpt_btrfs:
+        return [*MKFS_BTRFS_CMD]
+    if args.output_format == OutputFormat.gpt_xfs:
+        return [*MKFS_XFS_CMD]
 
-    with complete_step("Formatting ESP partition"):
-        run(["mkfs.fat", "-nEFI", "-F32", partition(loopdev, args.esp_partno)])
+    cmdline: List[PathString] = [*MKFS_EXT4_CMD]
 
+    if args.output_format == OutputFormat.gpt_ext4:
+        if args.distribution in (Distribution.centos, Distribution.centos_epel) and is_older_than_centos8(
+            args.release
+        ):
+            # e2fsprogs in centos7 is too old and doesn't support this feature
+            cmdline += ["-O", "^metadata_csum"]
 
-def prepare_xbootldr(args: CommandLineArguments, loopdev: Optional[Path], cached: bool) -> None:
-    if loopdev is None:
-        return
-    if cached:
-        return
-    if args.xbootldr_partno is None:
-        return
+        if args.architecture in ("x86_64", "aarch64"):
+            # enable 64bit filesystem feature on supported architectures
+            cmdline += ["-O", "64bit"]
 
-    with complete_step("Formatting XBOOTLDR partition"):
-        run(["mkfs.fat", "-nXBOOTLDR", "-F32", partition(loopdev, args.xbootldr_partno)])
+    return cmdline
 
 
-def mkfs_ext4_cmd(label: str, mount: PathString) -> List[str]:
-    return ["mkfs.ext4", "-I", "256", "-L", label, "-M", str(mount)]
+def mkfs_generic_cmd(base: Sequence[PathString], label: str, mount: PathString, dev: Path) -> List[PathString]:
+    cmdline = [*base, "-L", label]
 
+    if base[0] == "mkfs.ext4":
+        cmdline += ["-M", str(mount)]
 
-def mkfs_xfs_cmd(label: str) -> List[str]:
-    return ["mkfs.xfs", "-n", "ftype=1", "-L", label]
+    return [*cmdline, dev]
 
 
-def mkfs_btrfs_cmd(label: str) -> List[str]:
-    return ["mkfs.btrfs", "-L", label, "-d", "single", "-m", "single"]
+def luks_format_cmd(dev: Path, passphrase: Dict[str, str], minimal_pbkdf: bool = False) -> List[PathString]:
+    cmdline: List[PathString] = ["cryptsetup", "luksFormat", "--force-password"]
 
+    if minimal_pbkdf:
+        # PBKDF2 needs no memory and cryptsetup doesn't have to benchmark it when the iterations are forced
+        cmdline += ["--pbkdf=pbkdf2", "--hash=sha512", "--pbkdf-force-iterations=1000"]
+    else:
+        cmdline += ["--pbkdf-memory=64", "--pbkdf-parallel=1", "--pbkdf-force-iterations=1000"]
 
-def mkfs_generic(args: CommandLineArguments, label: str, mount: PathString, dev: Path) -> None:
-    cmdline: Sequence[PathString]
+    cmdline += ["--batch-mode", dev]
 
-    if args.output_format == OutputFormat.gpt_btrfs:
-        cmdline = mkfs_btrfs_cmd(label)
-    elif args.output_format == OutputFormat.gpt_xfs:
-        cmdline = mkfs_xfs_cmd(label)
+    if passphrase["type"] == "file":
+        cmdline += [passphrase["content"]]
     else:
-        cmdline = mkfs_ext4_cmd(label, mount)
+        assert passphrase["type"] == "stdin"
 
-    if args.output_format == OutputFormat.gpt_ext4:
-        if args.distribution in (Distribution.centos, Distribution.centos_epel) and is_older_than_centos8(
-            args.release
-        ):
-            # e2fsprogs in centos7 is too old and doesn't support this feature
-            cmdline += ["-O", "^metadata_csum"]
+    return cmdline
 
-        if args.architecture in ("x86_64", "aarch64"):
-            # enable 64bit filesystem feature on supported architectures
-            cmdline += ["-O", "64bit"]
 
-    run([*cmdline, dev])
+def luks_format_input(passphrase: Dict[str, str]) -> Optional[bytes]:
+    if passphrase["type"] == "stdin":
+        return (passphrase["content"] + "\n").encode("utf-8")
 
+    return None
 
-def luks_format(dev: Path, passphrase: Dict[str, str]) -> None:
-    if passphrase["type"] == "stdin":
-        passphrase_content = (passphrase["content"] + "\n").encode("utf-8")
-        run(
-            [
-                "cryptsetup",
-                "luksFormat",
-                "--force-password",
-                "--pbkdf-memory=64",
-                "--pbkdf-parallel=1",
-                "--pbkdf-force-iterations=1000",
-                "--batch-mode",
-                dev,
-            ],
-            input=passphrase_content,
-        )
-    else:
-        assert passphrase["type"] == "file"
-        run(
-            [
-                "cryptsetup",
-                "luksFormat",
-                "--force-password",
-                "--pbkdf-memory=64",
-                "--pbkdf-parallel=1",
-                "--pbkdf-force-iterations=1000",
-                "--batch-mode",
-                dev,
-                passphrase["content"],
-            ]
-        )
+
+def luks_format(dev: Path, passphrase: Dict[str, str], minimal_pbkdf: bool = False) -> None:
+    run(luks_format_cmd(dev, passphrase, minimal_pbkdf), input=luks_format_input(passphrase))
+
+
+# The partitions that may be encrypted and their mount points, in the order of LuksSetupOutput's fields
+LUKS_PARTITIONS = (
+    ("root", "root partition", "/"),
+    ("home", "home partition", "/home"),
+    ("srv", "server data partition", "/srv"),
+    ("var", "variable data partition", "/var"),
+    ("tmp", "temporary data partition", "/var/tmp"),
+)
+
+
+def luks_partno(args: CommandLineArguments, name: str, inserting_generated_root: bool = False) -> Optional[int]:
+    "The number of partition *name* if it is to be encrypted, None otherwise"
+    if args.encrypt is None:
+        return None
+    if name == "root":
+        if args.encrypt != "all":
+            return None
+        if args.generated_root and not inserting_generated_root:
+            return None
+
+    partno: Optional[int] = getattr(args, f"{name}_partno")
+    return partno
 
 
 def luks_format_root(
@@ -969,11 +1250,8 @@ def luks_format_root(
     cached: bool,
     inserting_generated_root: bool = False,
 ) -> None:
-    if args.encrypt != "all":
-        return
-    if args.root_partno is None:
-        return
-    if is_generated_root(args) and not inserting_generated_root:
+    partno = luks_partno(args, "root", inserting_generated_root)
+    if partno is None:
         return
     if do_run_build_script:
         return
@@ -982,72 +1260,42 @@ def luks_format_root(
     assert args.passphrase is not None
 
     with complete_step("Setting up LUKS on root partition…"):
-        luks_format(partition(loopdev, args.root_partno), args.passphrase)
+        luks_format(partition(loopdev, partno), args.passphrase, args.minimal_pbkdf)
 
 
-def luks_format_home(args: CommandLineArguments, loopdev: Path, do_run_build_script: bool, cached: bool) -> None:
+def luks_format_all(args: CommandLineArguments, loopdev: Path, do_run_build_script: bool, cached: bool) -> None:
     if args.encrypt is None:
         return
-    if args.home_partno is None:
-        return
     if do_run_build_script:
         return
     if cached:
         return
     assert args.passphrase is not None
 
-    with complete_step("Setting up LUKS on home partition…"):
-        luks_format(partition(loopdev, args.home_partno), args.passphrase)
-
+    parts: List[Tuple[str, int]] = []
+    for name, description, _ in LUKS_PARTITIONS:
+        partno = luks_partno(args, name)
+        if partno is not None:
+            parts += [(description, partno)]
 
-def luks_format_srv(args: CommandLineArguments, loopdev: Path, do_run_build_script: bool, cached: bool) -> None:
-    if args.encrypt is None:
-        return
-    if args.srv_partno is None:
+    if not parts:
         return
-    if do_run_build_script:
-        return
-    if cached:
-        return
-    assert args.passphrase is not None
-
-    with complete_step("Setting up LUKS on server data partition…"):
-        luks_format(partition(loopdev, args.srv_partno), args.passphrase)
-
-
-def luks_format_var(args: CommandLineArguments, loopdev: Path, do_run_build_script: bool, cached: bool) -> None:
-    if args.encrypt is None:
-        return
-    if args.var_partno is None:
-        return
-    if do_run_build_script:
-        return
-    if cached:
-        return
-    assert args.passphrase is not None
-
-    with complete_step("Setting up LUKS on variable data partition…"):
-        luks_format(partition(loopdev, args.var_partno), args.passphrase)
-
 
-def luks_format_tmp(args: CommandLineArguments, loopdev: Path, do_run_build_script: bool, cached: bool) -> None:
-    if args.encrypt is None:
-        return
-    if args.tmp_partno is None:
-        return
-    if do_run_build_script:
-        return
-    if cached:
-        return
-    assert args.passphrase is not None
+    # The partitions are independent of each other, so format all of them at the same time
+    with complete_step("Setting up LUKS on partitions…"):
+        for description, _ in parts:
+            MkosiPrinter.print_step(f"Setting up LUKS on {description}…")
 
-    with complete_step("Setting up LUKS on temporary data partition…"):
-        luks_format(partition(loopdev, args.tmp_partno), args.passphrase)
+        run_concurrently(
+            [luks_format_cmd(partition(loopdev, partno), args.passphrase, args.minimal_pbkdf) for _, partno in parts],
+            input=luks_format_input(args.passphrase),
+        )
 
 
 @contextlib.contextmanager
 def luks_open(dev: Path, passphrase: Dict[str, str], partition: str) -> Generator[Path, None, None]:
-    name = str(uuid.uuid4())
+    # The prefix makes stale mappings left behind by us easy to recognize
+    name = "mkosi-" + os.urandom(8).hex()
     # FIXME: partition is only used in messages, rename it?
 
     with complete_step(f"Setting up LUKS on {partition}…"):
@@ -1067,76 +1315,22 @@ def luks_open(dev: Path, passphrase: Dict[str, str], partition: str) -> Generato
             run(["cryptsetup", "close", path])
 
 
-def luks_setup_root(
-    args: CommandLineArguments, loopdev: Path, do_run_build_script: bool, inserting_generated_root: bool = False
-) -> ContextManager[Optional[Path]]:
-    if args.encrypt != "all":
-        return contextlib.nullcontext()
-    if args.root_partno is None:
-        return contextlib.nullcontext()
-    if is_generated_root(args) and not inserting_generated_root:
-        return contextlib.nullcontext()
-    if do_run_build_script:
-        return contextlib.nullcontext()
-    assert args.passphrase is not None
-
-    return luks_open(partition(loopdev, args.root_partno), args.passphrase, "root partition")
-
-
-def luks_setup_home(
-    args: CommandLineArguments, loopdev: Path, do_run_build_script: bool
-) -> ContextManager[Optional[Path]]:
-    if args.encrypt is None:
-        return contextlib.nullcontext()
-    if args.home_partno is None:
-        return contextlib.nullcontext()
-    if do_run_build_script:
-        return contextlib.nullcontext()
-    assert args.passphrase is not None
-
-    return luks_open(partition(loopdev, args.home_partno), args.passphrase, "home partition")
-
-
-def luks_setup_srv(
-    args: CommandLineArguments, loopdev: Path, do_run_build_script: bool
-) -> ContextManager[Optional[Path]]:
-    if args.encrypt is None:
-        return contextlib.nullcontext()
-    if args.srv_partno is None:
-        return contextlib.nullcontext()
-    if do_run_build_script:
-        return contextlib.nullcontext()
-    assert args.passphrase is not None
-
-    return luks_open(partition(loopdev, args.srv_partno), args.passphrase, "server data partition")
-
-
-def luks_setup_var(
-    args: CommandLineArguments, loopdev: Path, do_run_build_script: bool
-) -> ContextManager[Optional[Path]]:
-    if args.encrypt is None:
-        return contextlib.nullcontext()
-    if args.var_partno is None:
-        return contextlib.nullcontext()
-    if do_run_build_script:
-        return contextlib.nullcontext()
-    assert args.passphrase is not None
-
-    return luks_open(partition(loopdev, args.var_partno), args.passphrase, "variable data partition")
-
-
-def luks_setup_tmp(
-    args: CommandLineArguments, loopdev: Path, do_run_build_script: bool
+def luks_setup_partition(
+    args: CommandLineArguments,
+    loopdev: Path,
+    name: str,
+    description: str,
+    do_run_build_script: bool,
+    inserting_generated_root: bool = False,
 ) -> ContextManager[Optional[Path]]:
-    if args.encrypt is None:
-        return contextlib.nullcontext()
-    if args.tmp_partno is None:
+    partno = luks_partno(args, name, inserting_generated_root)
+    if partno is None:
         return contextlib.nullcontext()
     if do_run_build_script:
         return contextlib.nullcontext()
     assert args.passphrase is not None
 
-    return luks_open(partition(loopdev, args.tmp_partno), args.passphrase, "temporary data partition")
+    return luks_open(partition(loopdev, partno), args.passphrase, description)
 
 
 class LuksSetupOutput(NamedTuple):
@@ -1153,7 +1347,7 @@ class LuksSetupOutput(NamedTuple):
     def without_generated_root(self, args: CommandLineArguments) -> LuksSetupOutput:
         "A copy of self with .root optionally supressed"
         return LuksSetupOutput(
-            None if is_generated_root(args) else self.root,
+            None if args.generated_root else self.root,
             *self[1:],
         )
 
@@ -1168,79 +1362,67 @@ def luks_setup_all(
 
     assert loopdev is not None
 
-    with luks_setup_root(args, loopdev, do_run_build_script) as root, \
-         luks_setup_home(args, loopdev, do_run_build_script) as home, \
-         luks_setup_srv(args, loopdev, do_run_build_script) as srv, \
-         luks_setup_var(args, loopdev, do_run_build_script) as var, \
-         luks_setup_tmp(args, loopdev, do_run_build_script) as tmp:
-
-        yield LuksSetupOutput(
-            optional_partition(loopdev, args.root_partno) if root is None else root,
-            optional_partition(loopdev, args.home_partno) if home is None else home,
-            optional_partition(loopdev, args.srv_partno) if srv is None else srv,
-            optional_partition(loopdev, args.var_partno) if var is None else var,
-            optional_partition(loopdev, args.tmp_partno) if tmp is None else tmp,
-        )
-
-
-def prepare_root(args: CommandLineArguments, dev: Optional[Path], cached: bool) -> None:
-    if dev is None:
-        return
-    if is_generated_root(args):
-        return
-    if cached:
-        return
+    with contextlib.ExitStack() as stack:
+        devices: List[Optional[Path]] = []
+        for name, description, _ in LUKS_PARTITIONS:
+            dev = stack.enter_context(luks_setup_partition(args, loopdev, name, description, do_run_build_script))
+            if dev is None:
+                dev = optional_partition(loopdev, getattr(args, f"{name}_partno"))
+            devices += [dev]
 
-    label, path = ("usr", "/usr") if args.usr_only else ("root", "/")
-    with complete_step(f"Formatting {label} partition…"):
-        mkfs_generic(args, label, path, dev)
+        yield LuksSetupOutput(*devices)
 
 
-def prepare_home(args: CommandLineArguments, dev: Optional[Path], cached: bool) -> None:
-    if dev is None:
-        return
+def prepare_partitions(
+    args: CommandLineArguments, loopdev: Optional[Path], encrypted: LuksSetupOutput, cached: bool
+) -> None:
     if cached:
         return
 
-    with complete_step("Formatting home partition…"):
-        mkfs_generic(args, "home", "/home", dev)
+    jobs: List[Tuple[str, List[PathString]]] = []
 
+    if loopdev is not None:
+        if args.swap_partno is not None:
+            jobs += [("swap partition", ["mkswap", "-Lswap", partition(loopdev, args.swap_partno)])]
+        if args.esp_partno is not None:
+            jobs += [("ESP partition", ["mkfs.fat", "-nEFI", "-F32", partition(loopdev, args.esp_partno)])]
+        if args.xbootldr_partno is not None:
+            jobs += [
+                ("XBOOTLDR partition", ["mkfs.fat", "-nXBOOTLDR", "-F32", partition(loopdev, args.xbootldr_partno)])
+            ]
 
-def prepare_srv(args: CommandLineArguments, dev: Optional[Path], cached: bool) -> None:
-    if dev is None:
-        return
-    if cached:
-        return
+    # Work out the options shared by all partitions only once
+    base = mkfs_base_cmd(args)
 
-    with complete_step("Formatting server data partition…"):
-        mkfs_generic(args, "srv", "/srv", dev)
+    for (label, description, where), dev in zip(LUKS_PARTITIONS, encrypted):
+        if dev is None:
+            continue
+        if label == "root":
+            if args.generated_root:
+                continue
+            if args.usr_only:
+                label, description, where = "usr", "usr partition", "/usr"
 
+        jobs += [(description, mkfs_generic_cmd(base, label, where, dev))]
 
-def prepare_var(args: CommandLineArguments, dev: Optional[Path], cached: bool) -> None:
-    if dev is None:
-        return
-    if cached:
+    if not jobs:
         return
 
-    with complete_step("Formatting variable data partition…"):
-        mkfs_generic(args, "var", "/var", dev)
+    # The partitions are independent of each other, so format all of them at the same time
+    with complete_step("Formatting partitions…"):
+        for description, _ in jobs:
+            MkosiPrinter.print_step(f"Formatting {description}")
 
+        run_concurrently([cmdline for _, cmdline in jobs])
 
-def prepare_tmp(args: CommandLineArguments, dev: Optional[Path], cached: bool) -> None:
-    if dev is None:
-        return
-    if cached:
-        return
-
-    with complete_step("Formatting temporary data partition…"):
-        mkfs_generic(args, "tmp", "/var/tmp", dev)
 
-
-def mount_loop(args: CommandLineArguments, dev: Path, where: Path, read_only: bool = False) -> None:
+def mount_loop(
+    args: CommandLineArguments, dev: Path, where: Path, read_only: bool = False, discard: bool = True
+) -> None:
     os.makedirs(where, 0o755, True)
 
     options = []
-    if not args.output_format.is_squashfs():
+    if discard and not args.output_format.is_squashfs():
         options += ["discard"]
 
     compress = should_compress_fs(args)
@@ -1263,13 +1445,20 @@ def mount_bind(what: Path, where: Optional[Path] = None) -> Path:
 
     os.makedirs(what, 0o755, True)
     os.makedirs(where, 0o755, True)
-    run(["mount", "--bind", what, where])
+    try:
+        mount_syscall(what, where, flags=MS_BIND)
+    except OSError:
+        # Let mount(8) have a go, it'll explain what's wrong if it fails too
+        run(["mount", "--bind", what, where])
     return where
 
 
 def mount_tmpfs(where: Path) -> None:
     os.makedirs(where, 0o755, True)
-    run(["mount", "tmpfs", "-t", "tmpfs", where])
+    try:
+        mount_syscall("tmpfs", where, "tmpfs")
+    except OSError:
+        run(["mount", "tmpfs", "-t", "tmpfs", where])
 
 
 @contextlib.contextmanager
@@ -1279,48 +1468,51 @@ def mount_image(
     loopdev: Optional[Path],
     image: LuksSetupOutput,
     root_read_only: bool = False,
+    root_discard: bool = True,
 ) -> Generator[None, None, None]:
-    with complete_step("Mounting image…"):
-
-        if image.root is not None:
-            if args.usr_only:
-                # In UsrOnly mode let's have a bind mount at the top so that umount --recursive works nicely later
-                mount_bind(root)
-                mount_loop(args, image.root, root / "usr", root_read_only)
+    with contextlib.ExitStack() as stack:
+        with complete_step("Mounting image…"):
+
+            if image.root is not None:
+                if args.usr_only:
+                    # In UsrOnly mode let's have a bind mount at the top so that umount --recursive works nicely
+                    # later
+                    mount_bind(root)
+                    stack.callback(unmount_image, root)
+                    mount_loop(args, image.root, root / "usr", root_read_only)
+                else:
+                    mount_loop(args, image.root, root, root_read_only, root_discard)
+                    stack.callback(unmount_image, root)
             else:
-                mount_loop(args, image.root, root, root_read_only)
-        else:
-            # always have a root of the tree as a mount point so we can
-            # recursively unmount anything that ends up mounted there
-            mount_bind(root, root)
+                # always have a root of the tree as a mount point so we can
+                # recursively unmount anything that ends up mounted there
+                mount_bind(root, root)
+                stack.callback(unmount_image, root)
 
-        if image.home is not None:
-            mount_loop(args, image.home, root / "home")
+            # Everything else ends up below the root mount, so the recursive unmount registered above also cleans
+            # up after us if one of the following mounts fails.
+            mounts = [(dev, root / where.lstrip("/")) for (_, _, where), dev in zip(LUKS_PARTITIONS[1:], image[1:])]
 
-        if image.srv is not None:
-            mount_loop(args, image.srv, root / "srv")
+            if args.esp_partno is not None and loopdev is not None:
+                mounts += [(partition(loopdev, args.esp_partno), root / "efi")]
 
-        if image.var is not None:
-            mount_loop(args, image.var, root / "var")
+            if args.xbootldr_partno is not None and loopdev is not None:
+                mounts += [(partition(loopdev, args.xbootldr_partno), root / "boot")]
 
-        if image.tmp is not None:
-            mount_loop(args, image.tmp, root / "var/tmp")
+            for dev, where in mounts:
+                if dev is not None:
+                    mount_loop(args, dev, where)
 
-        if args.esp_partno is not None and loopdev is not None:
-            mount_loop(args, partition(loopdev, args.esp_partno), root / "efi")
+            # Make sure /tmp and /run are not part of the image
+            mount_tmpfs(root / "run")
+            mount_tmpfs(root / "tmp")
 
-        if args.xbootldr_partno is not None and loopdev is not None:
-            mount_loop(args, partition(loopdev, args.xbootldr_partno), root / "boot")
+        yield
 
-        # Make sure /tmp and /run are not part of the image
-        mount_tmpfs(root / "run")
-        mount_tmpfs(root / "tmp")
 
-    try:
-        yield
-    finally:
-        with complete_step("Unmounting image"):
-            umount(root)
+def unmount_image(root: Path) -> None:
+    with complete_step("Unmounting image"):
+        umount(root)
 
 
 def install_etc_hostname(args: CommandLineArguments, root: Path, cached: bool) -> None:
@@ -1329,18 +1521,28 @@ def install_etc_hostname(args: CommandLineArguments, root: Path, cached: bool) -
 
     etc_hostname = root / "etc/hostname"
 
-    # Always unlink first, so that we don't get in trouble due to a
-    # symlink or suchlike. Also if no hostname is configured we really
-    # don't want the file to exist, so that systemd's implicit
-    # hostname logic can take effect.
-    try:
-        os.unlink(etc_hostname)
-    except FileNotFoundError:
-        pass
+    # If no hostname is configured we really don't want the file to
+    # exist, so that systemd's implicit hostname logic can take effect.
+    if not args.hostname:
+        try:
+            os.unlink(etc_hostname)
+        except FileNotFoundError:
+            pass
+        return
 
-    if args.hostname:
-        with complete_step("Assigning hostname"):
-            etc_hostname.write_text(args.hostname + "\n")
+    with complete_step("Assigning hostname"):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+        try:
+            # Don't write through a symlink or suchlike
+            fd = os.open(etc_hostname, flags | os.O_CLOEXEC, 0o644)
+        except OSError as e:
+            if e.errno != errno.ELOOP:
+                raise
+            os.unlink(etc_hostname)
+            fd = os.open(etc_hostname, flags | os.O_CLOEXEC, 0o644)
+
+        with open(fd, "w") as f:
+            f.write(args.hostname + "\n")
 
 
 @contextlib.contextmanager
@@ -1401,8 +1603,42 @@ def mount_cache(args: CommandLineArguments, root: Path) -> Generator[None, None,
                 umount(d)
 
 
+MOUNTINFO_ESCAPE_RE = re.compile(r"\\([0-7]{3})")
+
+
+def mounts_below(where: PathString) -> List[str]:
+    "The mount points at or below *where*, in the order they need to be unmounted in"
+    where = os.path.realpath(where)
+    prefix = where.rstrip("/") + "/"
+
+    mounts = []
+    with open("/proc/self/mountinfo") as f:
+        for line in f:
+            # The mount point is the fifth field, with whitespace and backslashes octal-escaped
+            mountpoint = MOUNTINFO_ESCAPE_RE.sub(lambda m: chr(int(m.group(1), 8)), line.split()[4])
+            if mountpoint == where or mountpoint.startswith(prefix):
+                mounts.append(mountpoint)
+
+    # Children before their parents, and later mounts stacked on the same mount point before earlier ones
+    mounts.reverse()
+    mounts.sort(key=len, reverse=True)
+    return mounts
+
+
 def umount(where: Path) -> None:
-    run(["umount", "--recursive", "-n", where])
+    # This is what umount --recursive does, but without forking and executing it for every mount tree
+    try:
+        mounts = mounts_below(where)
+        if not mounts:
+            raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), str(where))
+
+        for mountpoint in mounts:
+            if libc().umount2(os.fsencode(mountpoint), 0) != 0:
+                e = ctypes.get_errno()
+                raise OSError(e, os.strerror(e), mountpoint)
+    except OSError:
+        # Let umount(8) deal with whatever is left, it'll explain what's wrong if it fails too
+        run(["umount", "--recursive", "-n", where])
 
 
 def configure_dracut(args: CommandLineArguments, root: Path) -> None:
@@ -1416,9 +1652,9 @@ def configure_dracut(args: CommandLineArguments, root: Path) -> None:
 
     dracut_dir.joinpath("30-mkosi-qemu.conf").write_text('add_dracutmodules+=" qemu "\n')
 
-    with dracut_dir.joinpath("30-mkosi-systemd-extras.conf").open("w") as f:
-        for extra in DRACUT_SYSTEMD_EXTRAS:
-            f.write(f'install_optional_items+=" {extra} "\n')
+    dracut_dir.joinpath("30-mkosi-systemd-extras.conf").write_text(
+        "".join(f'install_optional_items+=" {extra} "\n' for extra in DRACUT_SYSTEMD_EXTRAS)
+    )
 
     if args.hostonly_initrd:
         dracut_dir.joinpath("30-mkosi-filesystem.conf").write_text(
@@ -1444,7 +1680,7 @@ def configure_dracut(args: CommandLineArguments, root: Path) -> None:
 
 
 def prepare_tree_root(args: CommandLineArguments, root: Path) -> None:
-    if args.output_format == OutputFormat.subvolume and not is_generated_root(args):
+    if args.output_format == OutputFormat.subvolume and not args.generated_root:
         with complete_step("Setting up OS tree root…"):
             btrfs_subvol_create(root)
 
@@ -1468,7 +1704,7 @@ def prepare_tree(args: CommandLineArguments, root: Path, do_run_build_script: bo
         return
 
     with complete_step("Setting up basic OS tree…"):
-        if args.output_format in (OutputFormat.subvolume, OutputFormat.gpt_btrfs) and not is_generated_root(args):
+        if args.output_format in (OutputFormat.subvolume, OutputFormat.gpt_btrfs) and not args.generated_root:
             btrfs_subvol_create(root / "home")
             btrfs_subvol_create(root / "srv")
             btrfs_subvol_create(root / "var")
@@ -1481,33 +1717,32 @@ def prepare_tree(args: CommandLineArguments, root: Path, do_run_build_script: bo
         root.joinpath("etc/machine-id").write_text(f"{args.machine_id}\n")
 
         if not do_run_build_script and args.bootable:
+            # Parents are listed before their children
+            dirs: List[str] = []
+
             if args.xbootldr_partno is not None:
                 # Create directories for kernels and entries if this is enabled
-                root.joinpath("boot/EFI").mkdir(mode=0o700)
-                root.joinpath("boot/EFI/Linux").mkdir(mode=0o700)
-                root.joinpath("boot/loader").mkdir(mode=0o700)
-                root.joinpath("boot/loader/entries").mkdir(mode=0o700)
-                root.joinpath("boot", args.machine_id).mkdir(mode=0o700)
+                dirs += ["boot/EFI", "boot/EFI/Linux", "boot/loader", "boot/loader/entries", f"boot/{args.machine_id}"]
             else:
                 # If this is not enabled, let's create an empty directory on /boot
-                root.joinpath("boot").mkdir(mode=0o700)
+                dirs += ["boot"]
 
             if args.esp_partno is not None:
-                root.joinpath("efi/EFI").mkdir(mode=0o700)
-                root.joinpath("efi/EFI/BOOT").mkdir(mode=0o700)
-                root.joinpath("efi/EFI/systemd").mkdir(mode=0o700)
-                root.joinpath("efi/loader").mkdir(mode=0o700)
+                dirs += ["efi/EFI", "efi/EFI/BOOT", "efi/EFI/systemd", "efi/loader"]
 
                 if args.xbootldr_partno is None:
                     # Create directories for kernels and entries, unless the XBOOTLDR partition is turned on
-                    root.joinpath("efi/EFI/Linux").mkdir(mode=0o700)
-                    root.joinpath("efi/loader/entries").mkdir(mode=0o700)
-                    root.joinpath("efi", args.machine_id).mkdir(mode=0o700)
+                    dirs += ["efi/EFI/Linux", "efi/loader/entries", f"efi/{args.machine_id}"]
+
+            with open_close(root, os.O_RDONLY | os.O_DIRECTORY) as rootfd:
+                for d in dirs:
+                    os.mkdir(d, 0o700, dir_fd=rootfd)
 
+                if args.esp_partno is not None and args.xbootldr_partno is None:
                     # Create some compatibility symlinks in /boot in case that is not set up otherwise
-                    root.joinpath("boot/efi").symlink_to("../efi")
-                    root.joinpath("boot/loader").symlink_to("../efi/loader")
-                    root.joinpath("boot", args.machine_id).symlink_to(f"../efi/{args.machine_id}")
+                    os.symlink("../efi", "boot/efi", dir_fd=rootfd)
+                    os.symlink("../efi/loader", "boot/loader", dir_fd=rootfd)
+                    os.symlink(f"../efi/{args.machine_id}", f"boot/{args.machine_id}", dir_fd=rootfd)
 
             root.joinpath("etc/kernel").mkdir(mode=0o755)
 
@@ -1543,21 +1778,18 @@ def disable_pam_securetty(root: Path) -> None:
     patch_file(root / "etc/pam.d/login", _rm_securetty)
 
 
+@functools.lru_cache(maxsize=None)
 def url_exists(url: str) -> bool:
+    # The same mirror URL is probed again for the build and the final image, so remember the answer
     req = urllib.request.Request(url, method="HEAD")
     try:
-        if urllib.request.urlopen(req):
+        with urllib.request.urlopen(req):
             return True
     except Exception:
         pass
     return False
 
 
-def make_executable(path: Path) -> None:
-    st = path.stat()
-    os.chmod(path, st.st_mode | stat.S_IEXEC)
-
-
 def disable_kernel_install(args: CommandLineArguments, root: Path) -> None:
     # Let's disable the automatic kernel installation done by the kernel RPMs. After all, we want to built
     # our own unified kernels that include the root hash in the kernel command line and can be signed as a
@@ -1599,16 +1831,28 @@ def add_packages(
     assert args.base_packages is True or args.base_packages is False or args.base_packages == "conditional"
 
     if args.base_packages is True or (args.base_packages == "conditional" and conditional):
-        for name in names:
-            packages.add(f"({name} if {conditional})" if conditional else name)
+        if conditional:
+            packages.update(f"({name} if {conditional})" for name in names)
+        else:
+            packages.update(names)
 
 
 def sort_packages(packages: Set[str]) -> List[str]:
     """Sorts packages: normal first, paths second, conditional third"""
 
-    m = {"(": 2, "/": 1}
-    sort = lambda name: (m.get(name[0], 0), name)
-    return sorted(packages, key=sort)
+    normal: List[str] = []
+    paths: List[str] = []
+    conditional: List[str] = []
+    for name in packages:
+        if name[0] == "(":
+            conditional.append(name)
+        elif name[0] == "/":
+            paths.append(name)
+        else:
+            normal.append(name)
+
+    # Sort each group on its own, so that comparisons don't need a key function
+    return sorted(normal) + sorted(paths) + sorted(conditional)
 
 
 def make_rpm_list(args: CommandLineArguments, packages: Set[str], do_run_build_script: bool) -> Set[str]:
@@ -1640,111 +1884,35 @@ def make_rpm_list(args: CommandLineArguments, packages: Set[str], do_run_build_s
     return packages
 
 
-def clean_dnf_metadata(root: Path, always: bool) -> None:
-    """Remove dnf metadata if /bin/dnf is not present in the image
-
-    If dnf is not installed, there doesn't seem to be much use in
-    keeping the dnf metadata, since it's not usable from within the
-    image anyway.
-    """
-    paths = [
-        root / "var/lib/dnf",
-        *root.glob("var/log/dnf.*"),
-        *root.glob("var/log/hawkey.*"),
-        root / "var/cache/dnf",
-    ]
-
-    cond = always or not os.access(root / "bin/dnf", os.F_OK, follow_symlinks=False)
-
-    if not cond or not any(path.exists() for path in paths):
-        return
-
-    with complete_step("Cleaning dnf metadata…"):
-        for path in paths:
-            unlink_try_hard(path)
-
-
-def clean_yum_metadata(root: Path, always: bool) -> None:
-    """Remove yum metadata if /bin/yum is not present in the image"""
-    paths = [
-        root / "var/lib/yum",
-        *root.glob("var/log/yum.*"),
-        root / "var/cache/yum",
-    ]
-
-    cond = always or not os.access(root / "bin/yum", os.F_OK, follow_symlinks=False)
-
-    if not cond or not any(path.exists() for path in paths):
-        return
-
-    with complete_step("Cleaning yum metadata…"):
-        for path in paths:
-            unlink_try_hard(path)
-
-
-def clean_rpm_metadata(root: Path, always: bool) -> None:
-    """Remove rpm metadata if /bin/rpm is not present in the image"""
-    path = root / "var/lib/rpm"
-
-    cond = always or not os.access(root / "bin/rpm", os.F_OK, follow_symlinks=False)
-
-    if not cond or not path.exists():
-        return
-
-    with complete_step("Cleaning rpm metadata…"):
-        unlink_try_hard(path)
-
-
-def clean_tdnf_metadata(root: Path, always: bool) -> None:
-    """Remove tdnf metadata if /bin/tdnf is not present in the image"""
-    paths = [
-        *root.glob("var/log/tdnf.*"),
-        root / "var/cache/tdnf",
-    ]
-
-    cond = always or not os.access(root / "usr/bin/tdnf", os.F_OK, follow_symlinks=False)
-
-    if not cond or not any(path.exists() for path in paths):
+def clean_metadata(
+    root: Path, always: bool, name: str, tool: str, paths: Sequence[str], patterns: Sequence[str] = ()
+) -> None:
+    """Remove the metadata of package manager *name* if *tool* is not present in the image"""
+    # Check for the tool first, so that we don't look for the metadata at all when we're going to keep it
+    if not always and os.path.lexists(root / tool):
         return
 
-    with complete_step("Cleaning tdnf metadata…"):
-        for path in paths:
-            unlink_try_hard(path)
-
-
-def clean_apt_metadata(root: Path, always: bool) -> None:
-    """Remove apt metadata if /usr/bin/apt is not present in the image"""
-    paths = [
-        root / "var/lib/apt",
-        root / "var/log/apt",
-        root / "var/cache/apt",
-    ]
-
-    cond = always or not os.access(root / "usr/bin/apt", os.F_OK, follow_symlinks=False)
-
-    if not cond or not any(path.exists() for path in paths):
+    # glob() only yields paths that exist, so only the fixed paths need checking
+    existing = [root / path for path in paths if os.path.lexists(root / path)]
+    existing += [path for pattern in patterns for path in root.glob(pattern)]
+    if not existing:
         return
 
-    with complete_step("Cleaning apt metadata…"):
-        for path in paths:
+    with complete_step(f"Cleaning {name} metadata…"):
+        for path in existing:
             unlink_try_hard(path)
 
 
-def clean_dpkg_metadata(root: Path, always: bool) -> None:
-    """Remove dpkg metadata if /usr/bin/dpkg is not present in the image"""
-    paths = [
-        root / "var/lib/dpkg",
-        root / "var/log/dpkg.log",
-    ]
-
-    cond = always or not os.access(root / "usr/bin/dpkg", os.F_OK, follow_symlinks=False)
-
-    if not cond or not any(path.exists() for path in paths):
-        return
-
-    with complete_step("Cleaning dpkg metadata…"):
-        for path in paths:
-            unlink_try_hard(path)
+# The package managers whose metadata we know how to clean up: their name, the binary whose absence means the
+# package manager isn't available in the image, and the paths and glob patterns of their metadata
+PACKAGE_MANAGER_METADATA = (
+    ("dnf", "bin/dnf", ("var/lib/dnf", "var/cache/dnf"), ("var/log/dnf.*", "var/log/hawkey.*")),
+    ("yum", "bin/yum", ("var/lib/yum", "var/cache/yum"), ("var/log/yum.*",)),
+    ("rpm", "bin/rpm", ("var/lib/rpm",), ()),
+    ("tdnf", "usr/bin/tdnf", ("var/cache/tdnf",), ("var/log/tdnf.*",)),
+    ("apt", "usr/bin/apt", ("var/lib/apt", "var/log/apt", "var/cache/apt"), ()),
+    ("dpkg", "usr/bin/dpkg", ("var/lib/dpkg", "var/log/dpkg.log"), ()),
+)
 
 
 def clean_package_manager_metadata(args: CommandLineArguments, root: Path) -> None:
@@ -1752,6 +1920,10 @@ def clean_package_manager_metadata(args: CommandLineArguments, root: Path) -> No
 
     Try them all regardless of the distro: metadata is only removed if the
     package manager is present in the image.
+
+    If a package manager is not installed, there doesn't seem to be much use
+    in keeping its metadata, since it's not usable from within the image
+    anyway.
     """
 
     assert args.clean_package_metadata in (False, True, 'auto')
@@ -1760,12 +1932,9 @@ def clean_package_manager_metadata(args: CommandLineArguments, root: Path) -> No
 
     # we try then all: metadata will only be touched if any of them are in the
     # final image
-    clean_dnf_metadata(root, always=args.clean_package_metadata is True)
-    clean_yum_metadata(root, always=args.clean_package_metadata is True)
-    clean_rpm_metadata(root, always=args.clean_package_metadata is True)
-    clean_tdnf_metadata(root, always=args.clean_package_metadata is True)
-    clean_apt_metadata(root, always=args.clean_package_metadata is True)
-    clean_dpkg_metadata(root, always=args.clean_package_metadata is True)
+    always = args.clean_package_metadata is True
+    for name, tool, paths, patterns in PACKAGE_MANAGER_METADATA:
+        clean_metadata(root, always, name, tool, paths, patterns)
     # FIXME: implement cleanup for other package managers
 
 
@@ -1857,48 +2026,58 @@ class Repo(NamedTuple):
     gpgurl: Optional[str] = None
 
 
-def setup_dnf(args: CommandLineArguments, root: Path, repos: Sequence[Repo] = ()) -> None:
+DNF_REPO_TEMPLATE = "[{id}]\nname={name}\n{url}\ngpgkey={gpgkey}\n"
+DNF_MAIN_TEMPLATE = "[main]\ngpgcheck={gpgcheck}\n{default_repos}\n"
+
+
+@functools.lru_cache(maxsize=None)
+def dnf_repo_config(repos: Tuple[Repo, ...]) -> Tuple[str, bool]:
+    "Generate the contents of the repo file and whether GPG signatures can be checked"
+    # The host's GPG keys don't come and go while we run, so when several images are built with the same
+    # repositories, look them up and render the repo file only once.
     gpgcheck = True
 
-    repo_file = workspace(root) / "temp.repo"
-    with repo_file.open("w") as f:
-        for repo in repos:
-            gpgkey: Optional[str] = None
-
-            if repo.gpgpath.exists():
-                gpgkey = f"file://{repo.gpgpath}"
-            elif repo.gpgurl:
-                gpgkey = repo.gpgurl
-            else:
-                warn(f"GPG key not found at {repo.gpgpath}. Not checking GPG signatures.")
-                gpgcheck = False
+    sections = []
+    for repo in repos:
+        gpgkey: Optional[str] = None
 
-            f.write(
-                dedent(
-                    f"""\
-                    [{repo.id}]
-                    name={repo.name}
-                    {repo.url}
-                    gpgkey={gpgkey or ''}
-                    """
-                )
-            )
+        if repo.gpgpath.exists():
+            gpgkey = f"file://{repo.gpgpath}"
+        elif repo.gpgurl:
+            gpgkey = repo.gpgurl
+        else:
+            warn(f"GPG key not found at {repo.gpgpath}. Not checking GPG signatures.")
+            gpgcheck = False
+
+        sections += [DNF_REPO_TEMPLATE.format(id=repo.id, name=repo.name, url=repo.url, gpgkey=gpgkey or "")]
+
+    return "".join(sections), gpgcheck
+
+
+def setup_dnf(args: CommandLineArguments, root: Path, repos: Sequence[Repo] = ()) -> bool:
+    "Write the dnf configuration and return whether GPG signatures can be checked"
+    repo_config, gpgcheck = dnf_repo_config(tuple(repos))
+
+    repo_file = workspace(root) / "temp.repo"
+    repo_file.write_text(repo_config)
 
     if args.use_host_repositories:
         default_repos  = ""
     else:
         default_repos  = f"{'repodir' if args.distribution == Distribution.photon else 'reposdir'}={workspace(root)}"
 
+    config = DNF_MAIN_TEMPLATE.format(gpgcheck="1" if gpgcheck else "0", default_repos=default_repos)
+
+    if args.distribution != Distribution.photon:
+        # Downloading the packages, not resolving them, is what takes longest, so fetch them in parallel from the
+        # fastest mirror, and don't spend CPU time on rebuilding packages from delta RPMs. tdnf doesn't know
+        # about any of this.
+        config += "max_parallel_downloads=10\nfastestmirror=True\ndeltarpm=False\n"
+
     config_file = workspace(root) / "dnf.conf"
-    config_file.write_text(
-        dedent(
-            f"""\
-            [main]
-            gpgcheck={'1' if gpgcheck else '0'}
-            {default_repos }
-            """
-        )
-    )
+    config_file.write_text(config)
+
+    return gpgcheck
 
 
 @complete_step("Installing Photon…")
@@ -1907,7 +2086,7 @@ def install_photon(args: CommandLineArguments, root: Path, do_run_build_script:
     updates_url = "baseurl=https://packages.vmware.com/photon/$releasever/photon_updates_$releasever_$basearch"
     gpgpath = Path("/etc/pki/rpm-gpg/VMWARE-RPM-GPG-KEY")
 
-    setup_dnf(
+    gpgcheck = setup_dnf(
         args,
         root,
         repos=[
@@ -1926,7 +2105,7 @@ def install_photon(args: CommandLineArguments, root: Path, do_run_build_script:
         root,
         args.repositories or ["photon", "photon-updates"],
         packages,
-        gpgpath.exists(),
+        gpgcheck,
         do_run_build_script,
     )
 
@@ -1947,7 +2126,7 @@ def install_clear(args: CommandLineArguments, root: Path, do_run_build_script: b
     if not do_run_build_script and args.ssh:
         add_packages(args, packages, "openssh-server")
 
-    swupd_extract = shutil.which("swupd-extract")
+    swupd_extract = which("swupd-extract")
 
     if swupd_extract is None:
         die(
@@ -1996,12 +2175,13 @@ def install_fedora(args: CommandLineArguments, root: Path, do_run_build_script:
     else:
         args.releasever = args.release
 
-    arch = args.architecture or platform.machine()
+    arch = args.architecture or HOST_ARCHITECTURE
 
     if args.mirror:
         baseurl = urllib.parse.urljoin(args.mirror, f"releases/{args.release}/Everything/$basearch/os/")
         media = urllib.parse.urljoin(baseurl.replace("$basearch", arch), "media.repo")
-        if not url_exists(media):
+        # Rawhide is never under releases/, so don't bother asking the mirror about it
+        if args.release == "rawhide" or not url_exists(media):
             baseurl = urllib.parse.urljoin(args.mirror, f"development/{args.release}/Everything/$basearch/os/")
 
         release_url = f"baseurl={baseurl}"
@@ -2038,18 +2218,17 @@ def install_fedora(args: CommandLineArguments, root: Path, do_run_build_script:
     if not do_run_build_script and args.bootable:
         add_packages(args, packages, "kernel-core", "kernel-modules", "binutils", "dracut")
         add_packages(args, packages, "systemd-udev", conditional="systemd")
-        configure_dracut(args, root)
     if do_run_build_script:
         packages.update(args.build_packages)
     if not do_run_build_script and args.network_veth:
         add_packages(args, packages, "systemd-networkd", conditional="systemd")
     invoke_dnf(args, root, args.repositories or ["fedora", "updates"], packages, do_run_build_script)
 
-    root.joinpath("etc/locale.conf").write_text("LANG=C.UTF-8\n")
+    write_file(root / "etc/locale.conf", "LANG=C.UTF-8\n")
 
     # FIXME: should this be conditionalized on args.with_docs like in install_debian_or_ubuntu()?
     #        But we set LANG=C.UTF-8 anyway.
-    shutil.rmtree(root / "usr/share/locale", ignore_errors=True)
+    rmtree(root / "usr/share/locale", ignore_errors=True)
 
 
 @complete_step("Installing Mageia…")
@@ -2078,7 +2257,6 @@ def install_mageia(args: CommandLineArguments, root: Path, do_run_build_script:
     add_packages(args, packages, "basesystem-minimal")
     if not do_run_build_script and args.bootable:
         add_packages(args, packages, "kernel-server-latest", "binutils", "dracut")
-        configure_dracut(args, root)
         # Mageia ships /etc/50-mageia.conf that omits systemd from the initramfs and disables hostonly.
         # We override that again so our defaults get applied correctly on Mageia as well.
         root.joinpath("etc/dracut.conf.d/51-mkosi-override-mageia.conf").write_text(
@@ -2096,7 +2274,7 @@ def install_mageia(args: CommandLineArguments, root: Path, do_run_build_script:
 @complete_step("Installing OpenMandriva…")
 def install_openmandriva(args: CommandLineArguments, root: Path, do_run_build_script: bool) -> None:
     release = args.release.strip("'")
-    arch = args.architecture or platform.machine()
+    arch = args.architecture or HOST_ARCHITECTURE
 
     if release[0].isdigit():
         release_model = "rock"
@@ -2131,7 +2309,6 @@ def install_openmandriva(args: CommandLineArguments, root: Path, do_run_build_sc
     if not do_run_build_script and args.bootable:
         add_packages(args, packages, "systemd-boot", "systemd-cryptsetup", conditional="systemd")
         add_packages(args, packages, "kernel-release-server", "binutils", "dracut", "timezone")
-        configure_dracut(args, root)
     if args.network_veth:
         add_packages(args, packages, "systemd-networkd", conditional="systemd")
 
@@ -2175,7 +2352,7 @@ def invoke_yum(
 def invoke_dnf_or_yum(
     args: CommandLineArguments, root: Path, repositories: List[str], packages: Set[str], do_run_build_script: bool
 ) -> None:
-    if shutil.which("dnf") is None:
+    if which("dnf") is None:
         invoke_yum(args, root, repositories, packages, do_run_build_script)
     else:
         invoke_dnf(args, root, repositories, packages, do_run_build_script)
@@ -2378,7 +2555,6 @@ def install_centos(args: CommandLineArguments, root: Path, do_run_build_script:
     add_packages(args, packages, "centos-release", "systemd")
     if not do_run_build_script and args.bootable:
         add_packages(args, packages, "kernel", "dracut", "binutils")
-        configure_dracut(args, root)
         if old:
             add_packages(
                 args,
@@ -2397,15 +2573,13 @@ def install_centos(args: CommandLineArguments, root: Path, do_run_build_script:
     if do_run_build_script:
         packages.update(args.build_packages)
 
-    repos = args.repositories or default_repos
+    # Don't extend args.repositories in place, as we get here once for the build image and once for the final one
+    repos = list(args.repositories or default_repos)
 
     if args.distribution == Distribution.centos_epel:
         repos += ["epel"]
         add_packages(args, packages, "epel-release")
 
-    if do_run_build_script:
-        packages.update(args.build_packages)
-
     if not do_run_build_script and args.distribution == Distribution.centos_epel and args.network_veth:
         add_packages(args, packages, "systemd-networkd", conditional="systemd")
 
@@ -2421,21 +2595,18 @@ def install_rocky(args: CommandLineArguments, root: Path, do_run_build_script: b
     add_packages(args, packages, "rocky-release", "systemd")
     if not do_run_build_script and args.bootable:
         add_packages(args, packages, "kernel", "dracut", "binutils")
-        configure_dracut(args, root)
         add_packages(args, packages, "systemd-udev", conditional="systemd")
 
     if do_run_build_script:
         packages.update(args.build_packages)
 
-    repos = args.repositories or default_repos
+    # Don't extend args.repositories in place, as we get here once for the build image and once for the final one
+    repos = list(args.repositories or default_repos)
 
     if args.distribution == Distribution.rocky_epel:
         repos += ["epel"]
         add_packages(args, packages, "epel-release")
 
-    if do_run_build_script:
-        packages.update(args.build_packages)
-
     if not do_run_build_script and args.distribution == Distribution.rocky_epel and args.network_veth:
         add_packages(args, packages, "systemd-networkd", conditional="systemd")
 
@@ -2452,27 +2623,25 @@ def install_alma(args: CommandLineArguments, root: Path, do_run_build_script: bo
     add_packages(args, packages, "almalinux-release", "systemd")
     if not do_run_build_script and args.bootable:
         add_packages(args, packages, "kernel", "dracut", "binutils")
-        configure_dracut(args, root)
         add_packages(args, packages, "systemd-udev", conditional="systemd")
 
     if do_run_build_script:
         packages.update(args.build_packages)
 
-    repos = args.repositories or default_repos
+    # Don't extend args.repositories in place, as we get here once for the build image and once for the final one
+    repos = list(args.repositories or default_repos)
 
     if args.distribution == Distribution.alma_epel:
         repos += ["epel"]
         add_packages(args, packages, "epel-release")
 
-    if do_run_build_script:
-        packages.update(args.build_packages)
-
     if not do_run_build_script and args.distribution == Distribution.alma_epel and args.network_veth:
         add_packages(args, packages, "systemd-networkd", conditional="systemd")
 
     invoke_dnf_or_yum(args, root, repos, packages, do_run_build_script)
 
 
+@functools.lru_cache(maxsize=None)
 def debootstrap_knows_arg(arg: str) -> bool:
     return bytes("invalid option", "UTF-8") not in run(["debootstrap", arg], stdout=PIPE, check=False).stdout
 
@@ -2502,7 +2671,7 @@ def install_debian_or_ubuntu(args: CommandLineArguments, root: Path, *, do_run_b
     # Add it before debootstrap, as the second stage already uses dpkg from the chroot
     dpkg_io_conf = root / "etc/dpkg/dpkg.cfg.d/unsafe_io"
     os.makedirs(dpkg_io_conf.parent, mode=0o755, exist_ok=True)
-    dpkg_io_conf.write_text("force-unsafe-io\n")
+    write_file(dpkg_io_conf, "force-unsafe-io\n")
 
     assert args.mirror is not None
     cmdline += [args.release, root, args.mirror]
@@ -2520,7 +2689,6 @@ def install_debian_or_ubuntu(args: CommandLineArguments, root: Path, *, do_run_b
 
     if not do_run_build_script and args.bootable:
         add_packages(args, extra_packages, "dracut", "binutils")
-        configure_dracut(args, root)
 
         if args.distribution == Distribution.ubuntu:
             add_packages(args, extra_packages, "linux-generic")
@@ -2542,8 +2710,7 @@ def install_debian_or_ubuntu(args: CommandLineArguments, root: Path, *, do_run_b
     # Note: despite writing in /usr/sbin, this file is not shipped by the OS and instead should be managed by
     # the admin.
     policyrcd = root / "usr/sbin/policy-rc.d"
-    policyrcd.write_text("#!/bin/sh\nexit 101\n")
-    policyrcd.chmod(0o755)
+    write_file(policyrcd, "#!/bin/sh\nexit 101\n", 0o755)
 
     doc_paths = [
         "/usr/share/locale",
@@ -2555,15 +2722,28 @@ def install_debian_or_ubuntu(args: CommandLineArguments, root: Path, *, do_run_b
         "/usr/share/linda",
     ]
     if not args.with_docs:
-        # Remove documentation installed by debootstrap
-        cmdline = ["/bin/rm", "-rf", *doc_paths]
-        run_workspace_command(args, root, cmdline)
         # Create dpkg.cfg to ignore documentation on new packages
         dpkg_conf = root / "etc/dpkg/dpkg.cfg.d/01_nodoc"
         with dpkg_conf.open("w") as f:
             f.writelines(f"path-exclude {d}/*\n" for d in doc_paths)
 
-    cmdline = ["/usr/bin/apt-get", "--assume-yes", "--no-install-recommends", "install", *extra_packages]
+    # Don't let apt allocate a pty for every dpkg run just to draw a progress bar, and skip apt's own progress
+    # indicators as well, the per-package log lines are kept.
+    cmdline = [
+        "/usr/bin/apt-get",
+        "--quiet",
+        "--assume-yes",
+        "--no-install-recommends",
+        "-o", "Dpkg::Use-Pty=0",
+        "install",
+        *extra_packages,
+    ]
+
+    if not args.with_docs:
+        # Remove documentation installed by debootstrap in the same container that runs apt-get, rather than
+        # spinning up a separate one just to run rm.
+        cmdline = ["/bin/sh", "-c", f"/bin/rm -rf {' '.join(doc_paths)} && exec \"$@\"", "sh", *cmdline]
+
     env = {
         "DEBIAN_FRONTEND": "noninteractive",
         "DEBCONF_NONINTERACTIVE_SEEN": "true",
@@ -2625,7 +2805,32 @@ def patch_locale_gen(args: CommandLineArguments, root: Path) -> None:
         patch_file(root / "etc/locale.gen", _patch_line)
 
     except FileNotFoundError:
-        root.joinpath("etc/locale.gen").write_text("en_US.UTF-8 UTF-8\n")
+        write_file(root / "etc/locale.gen", "en_US.UTF-8 UTF-8\n")
+
+
+ARCH_FALLBACK_MIRROR = "https://geo.mirror.pkgbuild.com"
+
+# Permissions on these directories are all 0o777 because of 'mount --bind'
+# limitations but pacman expects them to be 0o755 so we fix them before
+# calling pacstrap (except /var/tmp which is 0o1777).
+ARCH_DIR_PERMISSIONS = (
+    ("boot", 0o755),
+    ("etc", 0o755),
+    ("etc/pacman.d", 0o755),
+    ("var", 0o755),
+    ("var/lib", 0o755),
+    ("var/cache", 0o755),
+    ("var/cache/pacman", 0o755),
+    ("var/tmp", 0o1777),
+    ("run", 0o755),
+)
+
+ARCH_KERNEL_PACKAGES = frozenset({
+    "linux",
+    "linux-lts",
+    "linux-hardened",
+    "linux-zen",
+})
 
 
 @complete_step("Installing Arch Linux…")
@@ -2634,7 +2839,7 @@ def install_arch(args: CommandLineArguments, root: Path, do_run_build_script: bo
         MkosiPrinter.info("Distribution release specification is not supported for Arch Linux, ignoring.")
 
     if args.mirror:
-        if platform.machine() == "aarch64":
+        if HOST_ARCHITECTURE == "aarch64":
             server = f"Server = {args.mirror}/$arch/$repo"
         else:
             server = f"Server = {args.mirror}/$repo/os/$arch"
@@ -2644,38 +2849,29 @@ def install_arch(args: CommandLineArguments, root: Path, do_run_build_script: bo
         # have fallback mirrors available if necessary. Finally, the mirrors will be more likely to be up to
         # date and we won't end up with a stable release that hardcodes a broken mirror.
         mirrorlist = workspace(root) / "mirrorlist"
-        with urllib.request.urlopen(
-            "https://www.archlinux.org/mirrorlist/?country=all&protocol=https&ip_version=4&use_mirror_status=on"
-        ) as r:
-            mirrors = r.readlines()
-            uncommented = [line.decode("utf-8")[1:] for line in mirrors]
-            with mirrorlist.open("w") as f:
-                f.writelines(uncommented)
+        try:
+            with urllib.request.urlopen(
+                "https://www.archlinux.org/mirrorlist/?country=all&protocol=https&ip_version=4&use_mirror_status=on",
+                timeout=10,
+            ) as r, mirrorlist.open("w") as f:
+                # Uncomment the mirrors as they arrive rather than reading the whole list into memory first
+                f.writelines(line.decode("utf-8")[1:] for line in r)
             server = f"Include = {mirrorlist}"
+        except OSError as e:
+            # Don't let a slow or unreachable mirrorlist generator stall or fail the build. Arch's GeoIP
+            # mirror redirects us to a nearby mirror instead.
+            warn(f"Failed to retrieve the Arch Linux mirror list ({e}), using {ARCH_FALLBACK_MIRROR} instead.")
+            server = f"Server = {ARCH_FALLBACK_MIRROR}/$repo/os/$arch"
 
     # Create base layout for pacman and pacman-key
     os.makedirs(root / "var/lib/pacman", 0o755, exist_ok=True)
     os.makedirs(root / "etc/pacman.d/gnupg", 0o755, exist_ok=True)
 
-    # Permissions on these directories are all 0o777 because of 'mount --bind'
-    # limitations but pacman expects them to be 0o755 so we fix them before
-    # calling pacstrap (except /var/tmp which is 0o1777).
-    fix_permissions_dirs = {
-        "boot": 0o755,
-        "etc": 0o755,
-        "etc/pacman.d": 0o755,
-        "var": 0o755,
-        "var/lib": 0o755,
-        "var/cache": 0o755,
-        "var/cache/pacman": 0o755,
-        "var/tmp": 0o1777,
-        "run": 0o755,
-    }
-
-    for dir, permissions in fix_permissions_dirs.items():
-        path = root / dir
-        if path.exists():
-            path.chmod(permissions)
+    for dir, permissions in ARCH_DIR_PERMISSIONS:
+        try:
+            os.chmod(root / dir, permissions)
+        except FileNotFoundError:
+            pass
 
     pacman_conf = workspace(root) / "pacman.conf"
     with pacman_conf.open("w") as f:
@@ -2692,6 +2888,7 @@ def install_arch(args: CommandLineArguments, root: Path, do_run_build_script: bo
                 Architecture = auto
                 Color
                 CheckSpace
+                ParallelDownloads = 5
                 SigLevel    = Required DatabaseOptional TrustAll
 
                 [core]
@@ -2749,7 +2946,7 @@ def install_arch(args: CommandLineArguments, root: Path, do_run_build_script: bo
             write_resource(hooks_dir / "60-mkosi-vmlinuz-remove.hook", "mkosi.resources.arch", "60_vmlinuz_remove.hook")
 
     keyring = "archlinux"
-    if platform.machine() == "aarch64":
+    if HOST_ARCHITECTURE == "aarch64":
         keyring += "arm"
 
     packages: Set[str] = set()
@@ -2766,18 +2963,10 @@ def install_arch(args: CommandLineArguments, root: Path, do_run_build_script: bo
             add_packages(args, packages, "grub")
 
         add_packages(args, packages, "dracut", "binutils")
-        configure_dracut(args, root)
 
     packages.update(args.packages)
 
-    official_kernel_packages = {
-        "linux",
-        "linux-lts",
-        "linux-hardened",
-        "linux-zen",
-    }
-
-    has_kernel_package = official_kernel_packages.intersection(args.packages)
+    has_kernel_package = ARCH_KERNEL_PACKAGES.intersection(args.packages)
     if not do_run_build_script and args.bootable and not has_kernel_package:
         # No user-specified kernel
         add_packages(args, packages, "linux")
@@ -2794,7 +2983,7 @@ def install_arch(args: CommandLineArguments, root: Path, do_run_build_script: bo
     patch_locale_gen(args, root)
     run_workspace_command(args, root, ["/usr/bin/locale-gen"])
 
-    root.joinpath("etc/locale.conf").write_text("LANG=en_US.UTF-8\n")
+    write_file(root / "etc/locale.conf", "LANG=en_US.UTF-8\n")
 
     # Arch still uses pam_securetty which prevents root login into
     # systemd-nspawn containers. See https://bugs.archlinux.org/task/45903.
@@ -2829,7 +3018,7 @@ def install_opensuse(args: CommandLineArguments, root: Path, do_run_build_script
     run(["zypper", "--root", root, "addrepo", "-ck", updates_url, "repo-update"])
 
     if not args.with_docs:
-        root.joinpath("etc/zypp/zypp.conf").write_text("rpm.install.excludedocs = yes\n")
+        write_file(root / "etc/zypp/zypp.conf", "rpm.install.excludedocs = yes\n")
 
     packages = {*args.packages}
     add_packages(args, packages, "systemd")
@@ -2841,7 +3030,6 @@ def install_opensuse(args: CommandLineArguments, root: Path, do_run_build_script
 
     if not do_run_build_script and args.bootable:
         add_packages(args, packages, "kernel-default", "dracut", "binutils")
-        configure_dracut(args, root)
 
         if args.bios_partno is not None:
             add_packages(args, packages, "grub2")
@@ -2916,6 +3104,12 @@ def install_distribution(args: CommandLineArguments, root: Path, do_run_build_sc
 
     disable_kernel_install(args, root)
 
+    # Everything but Clear Linux and Photon builds the initrd with dracut, so configure it before the packages
+    # get installed
+    uses_dracut = args.distribution not in (Distribution.clear, Distribution.photon)
+    if not do_run_build_script and args.bootable and uses_dracut:
+        configure_dracut(args, root)
+
     with mount_cache(args, root):
         install[args.distribution](args, root, do_run_build_script)
 
@@ -2994,15 +3188,17 @@ def set_root_password(args: CommandLineArguments, root: Path, do_run_build_scrip
             patch_file(root / "etc/shadow", set_root_pw)
 
 
-def invoke_fstrim(args: CommandLineArguments, root: Path, do_run_build_script: bool, for_cache: bool) -> None:
+def should_fstrim(args: CommandLineArguments, do_run_build_script: bool, for_cache: bool) -> bool:
+    return (
+        not do_run_build_script
+        and not args.generated_root
+        and args.output_format.is_disk()
+        and not for_cache
+    )
 
-    if do_run_build_script:
-        return
-    if is_generated_root(args):
-        return
-    if not args.output_format.is_disk():
-        return
-    if for_cache:
+
+def invoke_fstrim(args: CommandLineArguments, root: Path, do_run_build_script: bool, for_cache: bool) -> None:
+    if not should_fstrim(args, do_run_build_script, for_cache):
         return
 
     with complete_step("Trimming File System"):
@@ -3279,6 +3475,12 @@ def copy_git_files(src: Path, dest: Path, *, source_file_transfer: SourceFileTra
     what_files = ["--exclude-standard", "--cached"]
     if source_file_transfer == SourceFileTransfer.copy_git_others:
         what_files += ["--others", "--exclude=.mkosi-*"]
+        recurse = False
+    else:
+        # git can list the files of all submodules itself, saving us a git process per submodule, but it
+        # doesn't support that for untracked files
+        what_files += ["--recurse-submodules"]
+        recurse = True
 
     c = run(["git", "-C", src, "ls-files", "-z", *what_files], stdout=PIPE, universal_newlines=False, check=True)
     files = {x.decode("utf-8") for x in c.stdout.rstrip(b"\0").split(b"\0")}
@@ -3293,33 +3495,48 @@ def copy_git_files(src: Path, dest: Path, *, source_file_transfer: SourceFileTra
                 files.add(fr)
 
     # Get submodule files
-    c = run(["git", "-C", src, "submodule", "status", "--recursive"], stdout=PIPE, universal_newlines=True, check=True)
-    submodules = {x.split()[1] for x in c.stdout.splitlines()}
-
-    # workaround for git-ls-files returning the path of submodules that we will
-    # still parse
-    files -= submodules
-
-    for sm in submodules:
+    if not recurse:
         c = run(
-            ["git", "-C", os.path.join(src, sm), "ls-files", "-z"] + what_files,
-            stdout=PIPE,
-            universal_newlines=False,
-            check=True,
+            ["git", "-C", src, "submodule", "status", "--recursive"], stdout=PIPE, universal_newlines=True, check=True
         )
-        files |= {os.path.join(sm, x.decode("utf-8")) for x in c.stdout.rstrip(b"\0").split(b"\0")}
+        submodules = {x.split()[1] for x in c.stdout.splitlines()}
+
+        # workaround for git-ls-files returning the path of submodules that we will
+        # still parse
         files -= submodules
 
+        for sm in submodules:
+            c = run(
+                ["git", "-C", os.path.join(src, sm), "ls-files", "-z"] + what_files,
+                stdout=PIPE,
+                universal_newlines=False,
+                check=True,
+            )
+            files |= {os.path.join(sm, x.decode("utf-8")) for x in c.stdout.rstrip(b"\0").split(b"\0")}
+            files -= submodules
+
     del c
 
-    for path in files:
-        src_path = os.path.join(src, path)
-        dest_path = os.path.join(dest, path)
+    # Like copy_path(), copy the files from the shared thread pool, and only create each directory once
+    futures: List[concurrent.futures.Future[None]] = []
+    directories: Set[str] = set()
+
+    try:
+        for path in files:
+            src_path = os.path.join(src, path)
+            dest_path = os.path.join(dest, path)
 
-        directory = os.path.dirname(dest_path)
-        os.makedirs(directory, exist_ok=True)
+            directory = os.path.dirname(dest_path)
+            if directory not in directories:
+                os.makedirs(directory, exist_ok=True)
+                directories.add(directory)
 
-        copy_file(src_path, dest_path)
+            futures.append(io_executor().submit(copy_file, src_path, dest_path))
+    finally:
+        concurrent.futures.wait(futures)
+
+    for future in futures:
+        future.result()
 
 
 def install_build_src(args: CommandLineArguments, root: Path, do_run_build_script: bool, for_cache: bool) -> None:
@@ -3391,7 +3608,7 @@ def make_read_only(args: CommandLineArguments, root: Path, for_cache: bool, b: b
 
     if args.output_format not in (OutputFormat.gpt_btrfs, OutputFormat.subvolume):
         return
-    if is_generated_root(args):
+    if args.generated_root:
         return
 
     with complete_step("Marking root subvolume read-only"):
@@ -3399,7 +3616,7 @@ def make_read_only(args: CommandLineArguments, root: Path, for_cache: bool, b: b
 
 
 def xz_binary() -> str:
-    return "pxz" if shutil.which("pxz") else "xz"
+    return "pxz" if which("pxz") else "xz"
 
 
 def compressor_command(option: Union[str, bool]) -> List[str]:
@@ -3423,7 +3640,7 @@ def tar_binary() -> str:
     # everywhere. In particular given the limited/different SELinux
     # support in BSD tar and the different command line syntax
     # compared to GNU tar.
-    return "gtar" if shutil.which("gtar") else "tar"
+    return "gtar" if which("gtar") else "tar"
 
 
 def make_tar(args: CommandLineArguments, root: Path, do_run_build_script: bool, for_cache: bool) -> Optional[BinaryIO]:
@@ -3453,15 +3670,27 @@ def make_tar(args: CommandLineArguments, root: Path, do_run_build_script: bool,
     return f
 
 
-def find_files(root: Path) -> Generator[Path, None, None]:
+def find_files(root: Path) -> Generator[str, None, None]:
     """Generate a list of all filepaths relative to @root"""
     queue: Deque[Union[str, Path]] = collections.deque([root])
+    # Every entry is below root, so strip the prefix off the string rather than building a Path for each one
+    prefix = len(os.path.join(root, ""))
 
     while queue:
-        for entry in os.scandir(queue.pop()):
-            yield Path(entry.path).relative_to(root)
-            if entry.is_dir(follow_symlinks=False):
-                queue.append(entry.path)
+        with os.scandir(queue.pop()) as it:
+            for entry in it:
+                yield entry.path[prefix:]
+                if entry.is_dir(follow_symlinks=False):
+                    queue.append(entry.path)
+
+
+def grow_pipe(fd: int) -> None:
+    # The default pipe buffer is only 64K, a bigger one means fewer context switches between the processes on
+    # either end when streaming an archive through it.
+    try:
+        fcntl.fcntl(fd, F_SETPIPE_SZ, 1024 * 1024)
+    except OSError:
+        pass
 
 
 def make_cpio(
@@ -3485,13 +3714,17 @@ def make_cpio(
             "cpio", "-o", "--reproducible", "--null", "-H", "newc", "--quiet", "-D", root_dir
         ]
 
-        with spawn(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as cpio:
+        # Buffer the file list in big chunks rather than writing a few KiB to the pipe at a time
+        with spawn(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=1024 * 1024) as cpio:
             #  https://github.com/python/mypy/issues/10583
             assert cpio.stdin is not None
+            assert cpio.stdout is not None
+            grow_pipe(cpio.stdin.fileno())
+            grow_pipe(cpio.stdout.fileno())
 
             with spawn(compressor, stdin=cpio.stdout, stdout=f, delay_interrupt=False):
                 for file in files:
-                    cpio.stdin.write(os.fspath(file).encode("utf8") + b"\0")
+                    cpio.stdin.write(file.encode("utf8") + b"\0")
                 cpio.stdin.close()
         if cpio.wait() != 0:
             die("Failed to create archive")
@@ -3535,7 +3768,7 @@ def generate_ext4(args: CommandLineArguments, root: Path, label: str, for_cache:
             BinaryIO, tempfile.NamedTemporaryFile(prefix=".mkosi-mkfs-ext4", dir=os.path.dirname(args.output))
         )
         f.truncate(args.root_size)
-        run(["mkfs.ext4", "-I", "256", "-L", label, "-M", "/", "-d", root, f.name])
+        run([*MKFS_EXT4_CMD, "-L", label, "-M", "/", "-d", root, f.name])
 
     if args.minimize:
         with complete_step("Minimizing ext4 root file system…"):
@@ -3554,9 +3787,7 @@ def generate_btrfs(args: CommandLineArguments, root: Path, label: str, for_cache
         f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(prefix=".mkosi-mkfs-btrfs", dir=args.output.parent))
         f.truncate(args.root_size)
 
-        cmdline: Sequence[PathString] = [
-            "mkfs.btrfs", "-L", label, "-d", "single", "-m", "single", "--rootdir", root, f.name
-        ]
+        cmdline: Sequence[PathString] = [*MKFS_BTRFS_CMD, "-L", label, "--rootdir", root, f.name]
 
         if args.minimize:
             try:
@@ -3573,7 +3804,7 @@ def generate_btrfs(args: CommandLineArguments, root: Path, label: str, for_cache
 
 def make_generated_root(args: CommandLineArguments, root: Path, for_cache: bool) -> Optional[BinaryIO]:
 
-    if not is_generated_root(args):
+    if not args.generated_root:
         return None
 
     label = "usr" if args.usr_only else "root"
@@ -3739,7 +3970,7 @@ def insert_partition(
 
     if args.root_partno == partno:
         luks_format_root(args, loopdev, False, False, True)
-        cm = luks_setup_root(args, loopdev, False, True)
+        cm = luks_setup_partition(args, loopdev, "root", "root partition", False, True)
     else:
         cm = contextlib.nullcontext()
 
@@ -3759,7 +3990,7 @@ def insert_generated_root(
     image: Optional[BinaryIO],
     for_cache: bool,
 ) -> None:
-    if not is_generated_root(args):
+    if not args.generated_root:
         return
     if not args.output_format.is_disk():
         return
@@ -4091,22 +4322,24 @@ def copy_nspawn_settings(args: CommandLineArguments) -> Optional[BinaryIO]:
         )
 
         with open(args.nspawn_settings, "rb") as c:
-            f.write(c.read())
+            copy_file_object(c, f)
 
     return f
 
 
-def hash_file(of: TextIO, sf: BinaryIO, fname: str) -> None:
-    bs = 16 * 1024 ** 2
-    h = hashlib.sha256()
-
+def hash_file(sf: BinaryIO) -> str:
     sf.seek(0)
-    buf = sf.read(bs)
-    while len(buf) > 0:
-        h.update(buf)
-        buf = sf.read(bs)
 
-    of.write(h.hexdigest() + " *" + fname + "\n")
+    h = hashlib.sha256()
+    # Read into the same buffer over and over rather than allocating a new 16M bytes object for every chunk
+    buf = memoryview(bytearray(16 * 1024 ** 2))
+    while True:
+        n = sf.readinto(buf)  # type: ignore[attr-defined]
+        if not n:
+            break
+        h.update(buf[:n])
+
+    return h.hexdigest()
 
 
 def calculate_sha256sum(
@@ -4135,25 +4368,33 @@ def calculate_sha256sum(
             ),
         )
 
+        files: List[Tuple[BinaryIO, PathString]] = []
+
         if raw is not None:
-            hash_file(f, raw, os.path.basename(args.output))
+            files += [(raw, args.output)]
         if archive is not None:
-            hash_file(f, archive, os.path.basename(args.output))
+            files += [(archive, args.output)]
         if root_hash_file is not None:
             assert args.output_root_hash_file is not None
-            hash_file(f, root_hash_file, os.path.basename(args.output_root_hash_file))
+            files += [(root_hash_file, args.output_root_hash_file)]
         if split_root is not None:
             assert args.output_split_root is not None
-            hash_file(f, split_root, os.path.basename(args.output_split_root))
+            files += [(split_root, args.output_split_root)]
         if split_verity is not None:
             assert args.output_split_verity is not None
-            hash_file(f, split_verity, os.path.basename(args.output_split_verity))
+            files += [(split_verity, args.output_split_verity)]
         if split_kernel is not None:
             assert args.output_split_kernel is not None
-            hash_file(f, split_kernel, os.path.basename(args.output_split_kernel))
+            files += [(split_kernel, args.output_split_kernel)]
         if nspawn_settings is not None:
             assert args.output_nspawn_settings is not None
-            hash_file(f, nspawn_settings, os.path.basename(args.output_nspawn_settings))
+            files += [(nspawn_settings, args.output_nspawn_settings)]
+
+        # The files are independent and hashlib releases the GIL while hashing, so hash them all at once. map()
+        # hands back the results in order, which keeps SHA256SUMS stable.
+        digests = io_executor().map(hash_file, [sf for sf, _ in files])
+        for (_, path), digest in zip(files, digests):
+            f.write(digest + " *" + os.path.basename(path) + "\n")
 
         f.flush()
 
@@ -4853,6 +5094,11 @@ def create_parser() -> ArgumentParserMkosi:
     group.add_argument(
         "--encrypt", choices=("all", "data"), help='Encrypt everything except: ESP ("all") or ESP and root ("data")'
     )
+    group.add_argument(
+        "--minimal-pbkdf",
+        action=BooleanAction,
+        help="Use PBKDF2 with a minimal iteration count for the LUKS key slots instead of Argon2",
+    )
     group.add_argument("--verity", action=BooleanAction, help="Add integrity partition (implies --read-only)")
     group.add_argument(
         "--compress",
@@ -5468,14 +5714,70 @@ def unlink_try_hard(path: Optional[PathString]) -> None:
     except Exception:
         pass
 
-    if shutil.which("btrfs"):
+    if which("btrfs"):
         try:
             btrfs_subvol_delete(path)
             return
         except Exception:
             pass
 
-    shutil.rmtree(path)
+    rmtree(path)
+
+
+def rmtree(path: PathString, ignore_errors: bool = False) -> None:
+    """Like shutil.rmtree(), but with the files unlinked from the shared thread pool
+
+    With @ignore_errors, entries that can't be removed are skipped and
+    everything else is still removed, like shutil.rmtree() does.
+    """
+    try:
+        # Never follow a symlink at the top either, it might point to anything once resolved outside the image
+        if not stat.S_ISDIR(os.lstat(path).st_mode):
+            os.unlink(path)
+            return
+    except OSError:
+        if not ignore_errors:
+            raise
+        return
+
+    futures: List[concurrent.futures.Future[None]] = []
+    dirs: List[str] = []
+    todo = [os.fspath(path)]
+
+    try:
+        while todo:
+            d = todo.pop()
+            dirs.append(d)
+            try:
+                it = os.scandir(d)
+            except OSError:
+                if not ignore_errors:
+                    raise
+                continue
+
+            with it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        todo.append(entry.path)
+                    else:
+                        futures.append(io_executor().submit(os.unlink, entry.path))
+    finally:
+        concurrent.futures.wait(futures)
+
+    for future in futures:
+        try:
+            future.result()
+        except OSError:
+            if not ignore_errors:
+                raise
+
+    # Parents are listed before their children, hence go backwards to remove the deepest ones first
+    for d in reversed(dirs):
+        try:
+            os.rmdir(d)
+        except OSError:
+            if not ignore_errors:
+                raise
 
 
 def remove_glob(*patterns: PathString) -> None:
@@ -5869,7 +6171,7 @@ def load_args(args: argparse.Namespace) -> CommandLineArguments:
     if args.distribution == Distribution.clear and "," in args.boot_protocols:
         die("Sorry, Clear Linux does not support hybrid BIOS/UEFI images")
 
-    if shutil.which("bsdtar") and args.distribution == Distribution.openmandriva and args.tar_strip_selinux_context:
+    if which("bsdtar") and args.distribution == Distribution.openmandriva and args.tar_strip_selinux_context:
         die("Sorry, bsdtar on OpenMandriva is incompatible with --tar-strip-selinux-context")
 
     find_cache(args)
@@ -5881,9 +6183,9 @@ def load_args(args: argparse.Namespace) -> CommandLineArguments:
             args.mirror = "http://deb.debian.org/debian"
         elif args.distribution == Distribution.ubuntu:
             args.mirror = "http://archive.ubuntu.com/ubuntu"
-            if platform.machine() == "aarch64":
+            if HOST_ARCHITECTURE == "aarch64":
                 args.mirror = "http://ports.ubuntu.com/"
-        elif args.distribution == Distribution.arch and platform.machine() == "aarch64":
+        elif args.distribution == Distribution.arch and HOST_ARCHITECTURE == "aarch64":
             args.mirror = "http://mirror.archlinuxarm.org"
         elif args.distribution == Distribution.opensuse:
             args.mirror = "http://download.opensuse.org"
@@ -6140,6 +6442,9 @@ def load_args(args: argparse.Namespace) -> CommandLineArguments:
     # always the same
     args.machine_id = uuid.uuid4().hex
 
+    # This is checked all over the place while building, so only work it out once
+    args.generated_root = is_generated_root(args)
+
     return CommandLineArguments(**vars(args))
 
 
@@ -6270,6 +6575,8 @@ def print_summary(args: CommandLineArguments) -> None:
         MkosiPrinter.info("                     QCow2: " + yes_no(args.qcow2))
 
     MkosiPrinter.info("                Encryption: " + none_to_no(args.encrypt))
+    if args.encrypt:
+        MkosiPrinter.info("             Minimal PBKDF: " + yes_no(args.minimal_pbkdf))
     MkosiPrinter.info("                    Verity: " + yes_no(args.verity))
 
     if args.output_format.is_disk():
@@ -6531,23 +6838,11 @@ def build_image(
 
     with attach_image_loopback(args, raw) as loopdev:
 
-        prepare_swap(args, loopdev, cached)
-        prepare_esp(args, loopdev, cached)
-        prepare_xbootldr(args, loopdev, cached)
-
         if loopdev is not None:
-            luks_format_root(args, loopdev, do_run_build_script, cached)
-            luks_format_home(args, loopdev, do_run_build_script, cached)
-            luks_format_srv(args, loopdev, do_run_build_script, cached)
-            luks_format_var(args, loopdev, do_run_build_script, cached)
-            luks_format_tmp(args, loopdev, do_run_build_script, cached)
+            luks_format_all(args, loopdev, do_run_build_script, cached)
 
         with luks_setup_all(args, loopdev, do_run_build_script) as encrypted:
-            prepare_root(args, encrypted.root, cached)
-            prepare_home(args, encrypted.home, cached)
-            prepare_srv(args, encrypted.srv, cached)
-            prepare_var(args, encrypted.var, cached)
-            prepare_tmp(args, encrypted.tmp, cached)
+            prepare_partitions(args, loopdev, encrypted, cached)
 
             for dev in encrypted:
                 refresh_file_system(args, dev, cached)
@@ -6560,6 +6855,10 @@ def build_image(
                 root,
                 loopdev,
                 encrypted.without_generated_root(args),
+                # If we trim the root file system once we're done anyway, discarding every freed block while
+                # installing the image is just extra work. This only affects the file system mounted at the
+                # root, i.e. not /usr in UsrOnly mode, as that's the only one invoke_fstrim() trims.
+                root_discard=not should_fstrim(args, do_run_build_script, for_cache),
             ):
                 prepare_tree(args, root, do_run_build_script, cached)
                 if do_run_build_script and args.include_dir and not cached:
@@ -6848,7 +7147,7 @@ def check_root() -> None:
 
 
 def check_native(args: CommandLineArguments) -> None:
-    if args.architecture is not None and args.architecture != platform.machine() and args.build_script:
+    if args.architecture is not None and args.architecture != HOST_ARCHITECTURE and args.build_script:
         die("Cannot (currently) override the architecture and run build commands")
 
 
@@ -6933,7 +7232,7 @@ def run_shell(args: CommandLineArguments) -> None:
     if args.verb == "boot":
         cmdline += ["--boot"]
 
-    if is_generated_root(args) or args.verity:
+    if args.generated_root or args.verity:
         cmdline += ["--volatile=overlay"]
 
     if args.network_veth:
@@ -6958,14 +7257,14 @@ def run_shell(args: CommandLineArguments) -> None:
 
 def find_qemu_binary() -> str:
     ARCH_BINARIES = {"x86_64": "qemu-system-x86_64", "i386": "qemu-system-i386"}
-    arch_binary = ARCH_BINARIES.get(platform.machine())
+    arch_binary = ARCH_BINARIES.get(HOST_ARCHITECTURE)
 
     binaries: List[str] = []
     if arch_binary is not None:
         binaries += [arch_binary]
     binaries += ["qemu", "qemu-kvm"]
     for binary in binaries:
-        if shutil.which(binary) is not None:
+        if which(binary) is not None:
             return binary
 
     die("Couldn't find QEMU/KVM binary")
@@ -6978,7 +7277,7 @@ def find_qemu_firmware() -> Tuple[Path, bool]:
         *{
             "x86_64": ["/usr/share/ovmf/x64/OVMF_CODE.secboot.fd"],
             "i386": ["/usr/share/edk2/ovmf-ia32/OVMF_CODE.secboot.fd"],
-        }.get(platform.machine(), []),
+        }.get(HOST_ARCHITECTURE, []),
         "/usr/share/edk2/ovmf/OVMF_CODE.secboot.fd",
         "/usr/share/qemu/OVMF_CODE.secboot.fd",
         "/usr/share/ovmf/OVMF.secboot.fd",
@@ -7001,7 +7300,7 @@ def find_qemu_firmware() -> Tuple[Path, bool]:
                 "/usr/share/qemu/ovmf-x86_64.bin",
             ],
             "i386": ["/usr/share/ovmf/ovmf_code_ia32.bin", "/usr/share/edk2/ovmf-ia32/OVMF_CODE.fd"],
-        }.get(platform.machine(), []),
+        }.get(HOST_ARCHITECTURE, []),
         # After that, we try some generic paths and hope that if they exist,
         # they’ll correspond to the current architecture, thanks to the package manager.
         "/usr/share/edk2/ovmf/OVMF_CODE.fd",
@@ -7019,9 +7318,9 @@ def find_qemu_firmware() -> Tuple[Path, bool]:
 def find_ovmf_vars() -> Path:
     OVMF_VARS_LOCATIONS = []
 
-    if platform.machine() == "x86_64":
+    if HOST_ARCHITECTURE == "x86_64":
         OVMF_VARS_LOCATIONS += ["/usr/share/ovmf/x64/OVMF_VARS.fd"]
-    elif platform.machine() == "i386":
+    elif HOST_ARCHITECTURE == "i386":
         OVMF_VARS_LOCATIONS += ["/usr/share/edk2/ovmf-ia32/OVMF_VARS.fd"]
 
     OVMF_VARS_LOCATIONS += ["/usr/share/edk2/ovmf/OVMF_VARS.fd",
@@ -6,6 +6,7 @@ import argparse
 import contextlib
 import dataclasses
 import enum
+import functools
 import os
 import shlex
 import shutil
@@ -226,6 +227,7 @@ class CommandLineArguments:
     secure_boot_common_name: str
     read_only: bool
     encrypt: Optional[str]
+    minimal_pbkdf: bool
     verity: bool
     compress: Union[None, str, bool]
     compress_fs: Union[None, str, bool]
@@ -310,6 +312,7 @@ class CommandLineArguments:
     force: bool
     original_umask: int
     passphrase: Optional[Dict[str, str]]
+    generated_root: bool
 
     output_checksum: Optional[Path] = None
     output_nspawn_settings: Optional[Path] = None
@@ -379,6 +382,7 @@ def var_tmp(root: Path) -> Path:
     return p
 
 
+@functools.lru_cache(maxsize=64)
 def partition(loopdev: Path, partno: int) -> Path:
     return Path(f"{loopdev}p{partno}")
 
@@ -527,6 +531,47 @@ def run(
         die(f"{cmdline[0]} not found in PATH.")
 
 
+def run_concurrently(cmdlines: Sequence[Sequence[PathString]], input: Optional[bytes] = None) -> None:
+    """Run independent commands at the same time
+
+    Like run() with check=True, raises CalledProcessError if any of the
+    commands fails, but only after all of them have finished. The
+    processes are spawned from the calling thread, so interrupts are
+    delayed just like for run(). If input is given, it is fed to the
+    standard input of every command.
+    """
+    processes = []
+
+    with do_delay_interrupt():
+        try:
+            for cmdline in cmdlines:
+                p = spawn(
+                    [str(x) for x in cmdline],
+                    delay_interrupt=False,
+                    stdin=subprocess.PIPE if input is not None else None,
+                )
+                processes += [p]
+
+                if input is not None:
+                    assert p.stdin is not None
+                    # If the command exits without reading its input, its exit status is checked below
+                    try:
+                        p.stdin.write(input)
+                    except BrokenPipeError:
+                        pass
+                    try:
+                        p.stdin.close()
+                    except BrokenPipeError:
+                        pass
+        finally:
+            for p in processes:
+                p.wait()
+
+    for p in processes:
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+
+
 def run_with_backoff(
     cmdline: Sequence[PathString],
     check: bool = True,
@@ -559,12 +604,10 @@ def patch_file(filepath: Path, line_rewriter: Callable[[str], str]) -> None:
     temp_new_filepath = filepath.with_suffix(filepath.suffix + ".tmp.new")
 
     with filepath.open("r") as old, temp_new_filepath.open("w") as new:
-        for line in old:
-            new.write(line_rewriter(line))
+        new.writelines(map(line_rewriter, old))
 
     shutil.copystat(filepath, temp_new_filepath)
-    os.remove(filepath)
-    shutil.move(str(temp_new_filepath), filepath)
+    os.replace(temp_new_filepath, filepath)
 
 
 def path_relative_to_cwd(path: PathString) -> Path:
@@ -79,6 +79,7 @@ class MkosiConfig(object):
             "key": None,
             "manifest_format": None,
             "mirror": None,
+            "minimal_pbkdf": False,
             "mksquashfs_tool": [],
             "no_chown": False,
             "nspawn_settings": None,
@@ -249,6 +250,8 @@ class MkosiConfig(object):
                 self.reference_config[job_name]["read_only"] = mk_config_output["ReadOnly"]
             if "Encrypt" in mk_config_output:
                 self.reference_config[job_name]["encrypt"] = mk_config_output["Encrypt"]
+            if "MinimalPBKDF" in mk_config_output:
+                self.reference_config[job_name]["minimal_pbkdf"] = mk_config_output["MinimalPBKDF"]
             if "Verity" in mk_config_output:
                 self.reference_config[job_name]["verity"] = mk_config_output["Verity"]
             if "Compress" in mk_config_output: